@@ -0,0 +1,112 @@
+"""
+Micro-benchmark for the value types of hass_heaty.expr.
+
+For a set of typical operations, it reports the time per operation,
+the number of new hass_heaty.expr objects and the peak memory
+allocated while performing one operation.
+
+Run it from the repository's root directory:
+
+    python benchmarks/bench_expr.py
+"""
+
+import gc
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# pylint: disable=wrong-import-position
+from hass_heaty import expr
+
+
+# number of runs per operation for timing
+NUMBER = 100000
+
+# names of the functions that hand out objects of hass_heaty.expr
+CONSTRUCTORS = ("__init__", "_make")
+
+
+def sum_results():
+    """Does what Heaty.get_scheduled_temp does with the results of
+    an Add(-3) and a final Result(20) rule."""
+    result_sum = expr.Add(0)
+    for result in (expr.Add(-3), expr.Result(20)):
+        result_sum += result
+    return result_sum
+
+OPERATIONS = {
+    "Temp(21.5)": lambda: expr.Temp(21.5),
+    "Temp('21.5')": lambda: expr.Temp("21.5"),
+    "Temp + int": lambda: TEMP + 2,
+    "Temp - Temp": lambda: TEMP - TEMP,
+    "-Temp": lambda: -TEMP,
+    "OFF + int": lambda: OFF_TEMP + 2,
+    "Result(20)": lambda: expr.Result(20),
+    "Add + Result": lambda: ADD + RESULT,
+    "Break()": expr.Break,
+    "Ignore()": expr.Ignore,
+    "sum of results": sum_results,
+    "eval_temp_expr": lambda: expr.eval_temp_expr(CODE, env=ENV),
+}
+
+TEMP = expr.Temp(20)
+OFF_TEMP = expr.Temp(expr.OFF)
+ADD = expr.Add(-3)
+RESULT = expr.Result(20)
+CODE = compile("Add(-1) if 1 > 2 else 19.5", "temp_expr", "eval")
+ENV = expr.build_time_expression_env()
+
+
+def count_new_objects(func):
+    """Returns the number of objects of hass_heaty.expr created while
+    running func once. Shared instances that existed before aren't
+    counted."""
+
+    existing = set(id(obj) for obj in gc.get_objects())
+    handed_out = []
+
+    def profile(frame, event, arg):
+        """Collects the objects initialized or made by hass_heaty.expr."""
+        code = frame.f_code
+        if event == "return" and code.co_name in CONSTRUCTORS and \
+           code.co_filename == expr.__file__:
+            if code.co_name == "__init__":
+                handed_out.append(frame.f_locals["self"])
+            else:
+                handed_out.append(arg)
+
+    sys.setprofile(profile)
+    try:
+        func()
+    finally:
+        sys.setprofile(None)
+    return len(set(id(obj) for obj in handed_out) - existing)
+
+def measure_peak(func):
+    """Returns the peak number of bytes allocated while running func."""
+
+    tracemalloc.start()
+    try:
+        tracemalloc.clear_traces()
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def main():
+    """Runs all benchmarks and prints the results."""
+
+    print("{:<16} {:>10} {:>8} {:>10}"
+          .format("operation", "ns/op", "objects", "peak B/op"))
+    for name, func in OPERATIONS.items():
+        nsecs = timeit.timeit(func, number=NUMBER) / NUMBER * 1e9
+        print("{:<16} {:>10.0f} {:>8} {:>10}"
+              .format(name, nsecs, count_new_objects(func),
+                      measure_peak(func)))
+
+
+if __name__ == "__main__":
+    main()
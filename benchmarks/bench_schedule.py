@@ -0,0 +1,266 @@
+"""
+Benchmark suite for the hot code paths of hass_heaty.schedule,
+hass_heaty.expr and hass_heaty.config.
+
+Synthetic configurations of increasing size (from 1 room with 10 rules
+up to 500 rooms with 5000 rules) are generated, each with rules
+spanning multiple days and sub-schedules that are shared by all rooms
+via schedule_prepend and schedule_append. For every size, the time of
+parse_config, Schedule.get_matching_rules and Rule.check_constraints
+is measured, as well as the time of expr.eval_temp_expr and Temp
+arithmetic.
+
+Run it from the repository's root directory:
+
+    python benchmarks/bench_schedule.py --output results.json
+
+The results are printed and, if requested, written as JSON. Passing
+a previous results file with --compare reports every benchmark that
+got slower by more than the threshold and exits with status 1 in
+that case, which allows catching regressions automatically.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# pylint: disable=wrong-import-position
+from hass_heaty import __version__, config, expr
+
+
+# (number of rooms, number of rules in total) of the generated configs
+SIZES = ((1, 10), (10, 100), (50, 500), (100, 1000), (500, 5000))
+# sizes used with --quick
+QUICK_SIZES = SIZES[:3]
+# benchmarks taking less than this number of seconds are repeated
+MIN_TIME = 0.2
+# benchmarks taking at least this number of seconds are run only once
+SLOW_TIME = 2
+# default fraction by which a benchmark may get slower before it's
+# considered a regression
+DEFAULT_THRESHOLD = 0.2
+# seed for the random numbers, which keeps configs and samples the same
+# across runs
+SEED = 42
+# number of points in time sampled for lookups
+SAMPLES = 200
+
+# temperature expressions used for the expr benchmarks
+EXPRESSIONS = {
+    "constant": "19.5",
+    "conditional": "Add(-1) if 1 > 2 else 19.5",
+    "time": "22 if time.hour < 6 else Ignore()",
+    "date": "Result(18 + date.day % 3)",
+}
+
+
+def make_config(rooms, rules, rng):
+    """Returns a raw configuration with the given number of rooms and
+    rules in total. Some of the rules span multiple days, have
+    constraints or temperature expressions. A fixed number of rules is
+    placed in schedule_prepend and schedule_append, which are included
+    in every room's schedule."""
+
+    shared = max(1, rules // (10 * rooms))
+    per_room = max(1, (rules - 2 * shared) // rooms)
+
+    def make_rule(i):
+        """Returns a rule whose properties depend on i."""
+        start = rng.randrange(24 * 4) * 15
+        rule = {
+            "temp": 15 + i % 8,
+            "start": "{:02}:{:02}".format(start // 60, start % 60),
+        }
+        if i % 5 == 0:
+            rule["end_plus_days"] = 1 + i % 3
+        else:
+            end = min(24 * 60 - 1, start + 15 * (1 + rng.randrange(16)))
+            rule["end"] = "{:02}:{:02}".format(end // 60, end % 60)
+        if i % 3 == 0:
+            rule["weekdays"] = "1-5" if i % 2 else "6,7"
+        if i % 7 == 0:
+            rule["months"] = "1-3,10-12"
+        if i % 11 == 0:
+            rule["temp"] = "Add(-1) if date.day % 2 else Ignore()"
+        return rule
+
+    cfg = {
+        "module": "heaty_app",
+        "class": "Heaty",
+        "schedule_prepend": [
+            {"temp": "Ignore()", "weekdays": "6,7"}
+            for _ in range(shared)
+        ],
+        "schedule_append": [make_rule(i) for i in range(shared - 1)] +
+                           [{"temp": 15}],
+        "rooms": {},
+    }
+    for room in range(rooms):
+        cfg["rooms"]["room{}".format(room)] = {
+            "thermostats": {"climate.room{}".format(room): None},
+            "schedule": [make_rule(i) for i in range(per_room)],
+        }
+    return cfg
+
+def sample_datetimes(rng, days):
+    """Returns sorted random datetimes distributed over the given number
+    of days."""
+
+    start = datetime.datetime(2018, 1, 1)
+    return sorted(
+        start + datetime.timedelta(minutes=rng.randrange(days * 24 * 60))
+        for _ in range(SAMPLES)
+    )
+
+def measure(func, calls=1):
+    """Returns the number of nanoseconds per call of func. func itself
+    may perform the given number of calls at once."""
+
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    if elapsed >= SLOW_TIME:
+        # repeating would take too long, the first run has to suffice
+        return elapsed / number / calls * 1e9
+    if elapsed < MIN_TIME:
+        number = max(1, int(number * MIN_TIME / max(elapsed, 1e-9)))
+    best = min(timer.repeat(repeat=3, number=number))
+    return best / number / calls * 1e9
+
+def bench_size(rooms, rules, rng):
+    """Runs the config and schedule benchmarks for one size and returns
+    a dict mapping benchmark names to nanoseconds per operation."""
+
+    raw_cfg = make_config(rooms, rules, rng)
+    cfg = config.parse_config(raw_cfg)
+    scheds = [room["schedule"] for room in cfg["rooms"].values()]
+    all_rules = list(scheds[0].unfold())
+    # times during a single day hit the cached segments of the index,
+    # those distributed over a year require building them first
+    warm_whens = sample_datetimes(rng, 1)
+    cold_whens = sample_datetimes(rng, 365)
+    dates = [when.date() for when in cold_whens]
+    prefix = "{}x{}".format(rooms, rules)
+
+    def matching_rules(whens):
+        """Looks up the matching rules at every given time in all
+        rooms."""
+        for when in whens:
+            for sched in scheds:
+                for _ in sched.get_matching_rules(when):
+                    pass
+
+    def check_constraints():
+        """Checks the constraints of the rules of one room for every
+        sampled date."""
+        for date in dates:
+            for rule in all_rules:
+                rule.check_constraints(date)
+
+    return {
+        prefix + "/parse_config": measure(
+            lambda: config.parse_config(raw_cfg)
+        ),
+        prefix + "/get_matching_rules": measure(
+            lambda: matching_rules(warm_whens),
+            calls=len(warm_whens) * len(scheds)
+        ),
+        prefix + "/get_matching_rules_cold": measure(
+            lambda: matching_rules(cold_whens),
+            calls=len(cold_whens) * len(scheds)
+        ),
+        prefix + "/check_constraints": measure(
+            check_constraints, calls=len(dates) * len(all_rules)
+        ),
+    }
+
+def bench_expr():
+    """Runs the benchmarks of expression evaluation and Temp arithmetic
+    and returns a dict mapping their names to nanoseconds per
+    operation."""
+
+    env = expr.build_time_expression_env()
+    now = datetime.datetime(2018, 3, 5, 8, 0)
+    env.update(now=now, date=now.date(), time=now.time())
+    temp = expr.Temp(20)
+    off_temp = expr.Temp(expr.OFF)
+
+    results = {}
+    for name, temp_expr in EXPRESSIONS.items():
+        code = compile(temp_expr, "temp_expr", "eval")
+        results["eval_temp_expr/" + name] = measure(
+            lambda code=code: expr.eval_temp_expr(code, env=env)
+        )
+    results.update({
+        "temp/parse_str": measure(lambda: expr.Temp("21.5")),
+        "temp/add_int": measure(lambda: temp + 2),
+        "temp/sub_temp": measure(lambda: temp - temp),
+        "temp/add_off": measure(lambda: off_temp + 2),
+        "temp/compare": measure(lambda: temp < off_temp),
+        "result/add": measure(lambda: expr.Add(-3) + expr.Result(20)),
+    })
+    return results
+
+def compare(results, baseline, threshold):
+    """Returns a list of (name, old, new) tuples for every benchmark
+    which got slower by more than threshold compared to baseline."""
+
+    regressions = []
+    for name, new in sorted(results.items()):
+        old = baseline.get(name)
+        if old is not None and new > old * (1 + threshold):
+            regressions.append((name, old, new))
+    return regressions
+
+def main():
+    """Runs all benchmarks, prints and stores the results."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare with results from a previous run")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown as fraction (default: "
+                             "%(default)s)")
+    parser.add_argument("--quick", action="store_true",
+                        help="only use the smaller configurations")
+    args = parser.parse_args()
+
+    rng = random.Random(SEED)
+    results = {}
+    for rooms, rules in QUICK_SIZES if args.quick else SIZES:
+        results.update(bench_size(rooms, rules, rng))
+    results.update(bench_expr())
+
+    for name, nsecs in sorted(results.items()):
+        print("{:<40} {:>14.0f} ns/op".format(name, nsecs))
+
+    if args.output:
+        with open(args.output, "w") as fileobj:
+            json.dump({
+                "version": __version__,
+                "python": platform.python_version(),
+                "date": datetime.datetime.now().isoformat(),
+                "results": results,
+            }, fileobj, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fileobj:
+            baseline = json.load(fileobj)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for name, old, new in regressions:
+            print("!!! {} got slower: {:.0f} -> {:.0f} ns/op ({:+.0%})"
+                  .format(name, old, new, new / old - 1))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,342 @@
+"""
+A local stand-in for appdaemon.appapi.AppDaemon, which allows running
+the Heaty app without AppDaemon and Home Assistant.
+
+Time is virtual: timers fire when the clock is advanced with
+run_until(). Entity states are kept in a dict, and changing them with
+change_state() invokes the registered state listeners. Calls to the
+AppDaemon API that would hit Home Assistant's API (get_state, set_state
+and call_service) don't take real time, but their simulated latency is
+accounted for in io_time.
+
+Thermostats can be simulated as well: when register_thermostat() has
+been called for an entity, calls to the climate services update its
+state after a delay, as a real device would.
+
+install() makes this module available as appdaemon.appapi, which needs
+to be done before importing hass_heaty.app.
+"""
+
+import datetime
+import heapq
+import itertools
+import sys
+import time
+import types
+
+
+# default simulated latency of calls to Home Assistant's API in seconds
+DEFAULT_IO_LATENCY = {
+    "get_state": 0.002,
+    "get_state_all": 0.02,
+    "set_state": 0.003,
+    "call_service": 0.005,
+}
+
+
+class AppDaemon:
+    """Implements the parts of appdaemon.appapi.AppDaemon Heaty uses."""
+
+    # pylint: disable=too-many-instance-attributes,too-many-public-methods
+
+    def __init__(self, name="heaty", logger=None, error=None, args=None,
+                 global_vars=None, states=None, now=None, io_latency=None):
+        # pylint: disable=too-many-arguments,unused-argument
+        self.name = name
+        self.args = args or {}
+        self.states = states if states is not None else {}
+        self.now = now or datetime.datetime(2018, 1, 1)
+        self.io_latency = dict(DEFAULT_IO_LATENCY)
+        self.io_latency.update(io_latency or {})
+        self.io_time = 0
+        self.counts = {}
+        self.service_calls = {}
+        self.thermostats = {}
+        self.logs = []
+        self.print_logs = False
+        # heap of (when, seq, handle, callback, kwargs, interval)
+        self._timers = []
+        self._seq = itertools.count()
+        self._cancelled = set()
+        self._state_listeners = {}
+        self._event_listeners = {}
+        # called with (kind, name, seconds) after every callback
+        self.callback_hook = None
+
+    def _count(self, name, latency_key=None):
+        """Counts a call to the API and accounts for its latency."""
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.io_time += self.io_latency.get(latency_key or name, 0)
+
+    def _run_callback(self, kind, name, func, *args):
+        """Runs a callback and reports its duration, including the
+        simulated I/O time, to callback_hook."""
+
+        io_before = self.io_time
+        start = time.perf_counter()
+        func(*args)
+        if self.callback_hook is not None:
+            elapsed = time.perf_counter() - start + self.io_time - io_before
+            self.callback_hook(kind, name, elapsed)
+
+    # logging and time
+
+    def log(self, msg, level="INFO"):
+        """Stores the message and prints it if print_logs is set."""
+        self.logs.append((self.now, level, msg))
+        if self.print_logs:
+            print("{} {} {}".format(self.now, level, msg))
+
+    def datetime(self):
+        """Returns the virtual time."""
+        return self.now
+
+    def date(self):
+        """Returns the virtual date."""
+        return self.now.date()
+
+    def time(self):
+        """Returns the virtual time of the day."""
+        return self.now.time()
+
+    # states
+
+    def get_state(self, entity_id=None, attribute=None):
+        """Works like AppDaemon's get_state, but reads from self.states."""
+
+        if entity_id is None:
+            self._count("get_state", "get_state_all")
+            return {name: dict(state) for name, state in self.states.items()}
+        self._count("get_state")
+        state = self.states.get(entity_id)
+        if state is None or attribute == "all":
+            return state
+        if attribute is None:
+            return state.get("state")
+        if attribute in state:
+            return state[attribute]
+        return state.get("attributes", {}).get(attribute)
+
+    def set_state(self, entity, state=None, attributes=None, **kwargs):
+        """Sets the state of an entity, invoking the state listeners."""
+        # pylint: disable=unused-argument
+        self._count("set_state")
+        self.change_state(entity, state, attributes or {})
+
+    def listen_state(self, callback, entity=None, attribute=None,
+                     duration=None, **kwargs):
+        """Registers a state listener for a single entity."""
+
+        handle = next(self._seq)
+        self._state_listeners[handle] = (callback, entity, attribute,
+                                         duration, kwargs)
+        return handle
+
+    def cancel_listen_state(self, handle):
+        """Removes a state listener."""
+        self._state_listeners.pop(handle, None)
+
+    def change_state(self, entity, state=None, attributes=None):
+        """Changes the state and/or attributes of an entity as Home
+        Assistant would and invokes the listeners of that entity."""
+
+        old = self.states.get(entity)
+        new = {
+            "entity_id": entity,
+            "state": state if state is not None
+                     else (old or {}).get("state"),
+            "attributes": dict((old or {}).get("attributes", {})),
+            "last_changed": self.now.isoformat(),
+        }
+        new["attributes"].update(attributes or {})
+        self.states[entity] = new
+
+        for callback, ent, attribute, duration, kwargs in \
+                list(self._state_listeners.values()):
+            if ent != entity:
+                continue
+            if attribute == "all":
+                old_value, new_value = old, new
+            elif attribute:
+                old_value = (old or {}).get("attributes", {}).get(attribute)
+                new_value = new["attributes"].get(attribute)
+            else:
+                old_value = (old or {}).get("state")
+                new_value = new["state"]
+            if old_value == new_value:
+                continue
+            attr_name = attribute or "state"
+            if duration:
+                self.run_in(self._duration_cb, duration, listener=callback,
+                            entity=entity, attribute=attr_name,
+                            old=old_value, new=new_value, kwargs=kwargs)
+                continue
+            self._run_callback("state", callback.__name__, callback,
+                               entity, attr_name, old_value, new_value,
+                               dict(kwargs))
+
+    def _duration_cb(self, kwargs):
+        """Invokes a state listener registered with a duration, if the
+        state didn't change in the meantime."""
+
+        state = self.states.get(kwargs["entity"], {})
+        if kwargs["attribute"] == "state":
+            current = state.get("state")
+        else:
+            current = state.get("attributes", {}).get(kwargs["attribute"])
+        if current != kwargs["new"]:
+            return
+        callback = kwargs["listener"]
+        self._run_callback("state", callback.__name__, callback,
+                           kwargs["entity"], kwargs["attribute"],
+                           kwargs["old"], kwargs["new"],
+                           dict(kwargs["kwargs"]))
+
+    # events
+
+    def listen_event(self, callback, event=None, **kwargs):
+        """Registers an event listener. Keyword arguments have to match
+        the event data for the callback to be invoked."""
+
+        handle = next(self._seq)
+        self._event_listeners[handle] = (callback, event, kwargs)
+        return handle
+
+    def fire_event(self, event, **data):
+        """Fires an event, invoking the matching listeners."""
+
+        for callback, name, kwargs in list(self._event_listeners.values()):
+            if name != event:
+                continue
+            if any(data.get(key) != value for key, value in kwargs.items()):
+                continue
+            self._run_callback("event", callback.__name__, callback,
+                               event, data, dict(kwargs))
+
+    # timers
+
+    def _add_timer(self, when, callback, kwargs, interval=None):
+        """Adds a timer and returns its handle."""
+
+        handle = next(self._seq)
+        heapq.heappush(self._timers, (when, next(self._seq), handle,
+                                      callback, kwargs, interval))
+        return handle
+
+    def run_in(self, callback, seconds, **kwargs):
+        """Runs callback in the given number of seconds."""
+        return self._add_timer(
+            self.now + datetime.timedelta(seconds=seconds), callback, kwargs
+        )
+
+    def run_at(self, callback, start, **kwargs):
+        """Runs callback at the given datetime."""
+        if start < self.now:
+            raise ValueError("run_at() time is in the past: {}"
+                             .format(start))
+        return self._add_timer(start, callback, kwargs)
+
+    def run_once(self, callback, start, **kwargs):
+        """Runs callback once at the given time of the day."""
+        when = datetime.datetime.combine(self.now.date(), start)
+        if when < self.now:
+            when += datetime.timedelta(days=1)
+        return self._add_timer(when, callback, kwargs)
+
+    def run_daily(self, callback, start, **kwargs):
+        """Runs callback every day at the given time of the day."""
+        when = datetime.datetime.combine(self.now.date(), start)
+        if when < self.now:
+            when += datetime.timedelta(days=1)
+        return self._add_timer(when, callback, kwargs,
+                               datetime.timedelta(days=1))
+
+    def run_every(self, callback, start, interval, **kwargs):
+        """Runs callback every interval seconds, starting at start."""
+        return self._add_timer(start, callback, kwargs,
+                               datetime.timedelta(seconds=interval))
+
+    def cancel_timer(self, handle):
+        """Cancels a timer."""
+        self._cancelled.add(handle)
+
+    def run_until(self, until):
+        """Advances the virtual clock to until, running all timers due
+        up to then in order."""
+
+        while self._timers and self._timers[0][0] <= until:
+            when, _, handle, callback, kwargs, interval = \
+                heapq.heappop(self._timers)
+            if handle in self._cancelled:
+                self._cancelled.discard(handle)
+                continue
+            self.now = when
+            if interval:
+                heapq.heappush(self._timers, (when + interval,
+                                              next(self._seq), handle,
+                                              callback, kwargs, interval))
+            if getattr(callback, "__func__", None) in INTERNAL_TIMERS:
+                # internal timers aren't measured, only the callbacks
+                # they invoke
+                callback(dict(kwargs))
+                continue
+            self._run_callback("timer", callback.__name__, callback,
+                               dict(kwargs))
+        self.now = until
+
+    # services
+
+    def call_service(self, service, **kwargs):
+        """Records the service call. Calls to climate services for
+        registered thermostats update their states after their
+        delay."""
+
+        self._count("call_service")
+        self.service_calls[service] = self.service_calls.get(service, 0) + 1
+
+        entity_ids = kwargs.get("entity_id")
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        for entity in entity_ids or ():
+            device = self.thermostats.get(entity)
+            if device is None or device["drop"]():
+                continue
+            attributes = {key: value for key, value in kwargs.items()
+                          if key != "entity_id"}
+            self.run_in(self._thermostat_cb, device["delay"], entity=entity,
+                        attributes=attributes)
+
+    def register_thermostat(self, entity, delay=1, drop=None, **attributes):
+        """Simulates a thermostat that takes delay seconds to report
+        attributes sent to it via a service back in its state.
+        drop may be a function returning True for commands that should
+        get lost. The initial attributes are given as keyword
+        arguments."""
+
+        self.thermostats[entity] = {
+            "delay": delay,
+            "drop": drop or (lambda: False),
+        }
+        self.states[entity] = {
+            "entity_id": entity,
+            "state": "auto",
+            "attributes": attributes,
+        }
+
+    def _thermostat_cb(self, kwargs):
+        """Applies a command sent to a simulated thermostat."""
+        self.change_state(kwargs["entity"], attributes=kwargs["attributes"])
+
+
+# callbacks of timers the fake itself uses
+INTERNAL_TIMERS = (AppDaemon._duration_cb,  # pylint: disable=protected-access
+                   AppDaemon._thermostat_cb)  # pylint: disable=protected-access
+
+
+def install():
+    """Makes this module importable as appdaemon.appapi."""
+
+    package = types.ModuleType("appdaemon")
+    package.appapi = sys.modules[__name__]
+    sys.modules["appdaemon"] = package
+    sys.modules["appdaemon.appapi"] = sys.modules[__name__]
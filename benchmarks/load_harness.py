@@ -0,0 +1,250 @@
+"""
+End-to-end load harness for the Heaty app.
+
+The app is run on top of the fake AppDaemon from fake_appdaemon.py with
+a synthetic configuration and simulated thermostats. During a period of
+virtual time, bursts of thermostat attribute updates, window toggles
+and heaty_set_temp events arrive at the configured rates, modelled as
+Poisson processes. Afterwards, the percentiles of the callbacks'
+latencies (CPU time plus simulated I/O time) and the numbers of calls
+made to Home Assistant are reported.
+
+Run it from the repository's root directory:
+
+    python benchmarks/load_harness.py --rooms 50 --duration 3600 \\
+        --thermostat-rate 20 --window-rate 1 --set-temp-rate 0.5
+
+Pass --json to get the report in a machine-readable format.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# pylint: disable=wrong-import-position
+import fake_appdaemon
+
+fake_appdaemon.install()
+
+from hass_heaty.app import Heaty  # pylint: disable=wrong-import-order
+
+
+# percentiles reported for callback latencies
+PERCENTILES = (50, 90, 99, 100)
+# seed for the random numbers, which makes runs reproducible
+SEED = 42
+
+
+class LoadHarness:
+    """Drives a Heaty app with random events and collects statistics."""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.latencies = {}
+        self.thermostats = []
+        self.window_sensors = []
+        self.rooms = []
+
+        states = {}
+        self.app = Heaty(args=self.make_config(), states=states,
+                         now=datetime.datetime(2018, 1, 1, 6, 0))
+        self.app.io_latency.update(
+            get_state=args.io_latency,
+            get_state_all=args.io_latency * 10,
+            set_state=args.io_latency,
+            call_service=args.io_latency,
+        )
+        for therm_name in self.thermostats:
+            self.app.register_thermostat(
+                therm_name, delay=args.ack_delay,
+                drop=lambda: self.rng.random() < args.drop_rate,
+                operation_mode="Heat", temperature=20,
+                current_temperature=20,
+            )
+        for sensor_name in self.window_sensors:
+            states[sensor_name] = {"entity_id": sensor_name, "state": "off",
+                                   "attributes": {}}
+        self.app.callback_hook = self.record_latency
+
+    def make_config(self):
+        """Returns the configuration of the app."""
+
+        rooms = {}
+        for room in range(self.args.rooms):
+            room_name = "room{}".format(room)
+            thermostats = {}
+            for therm in range(self.args.thermostats):
+                therm_name = "climate.room{}_{}".format(room, therm)
+                thermostats[therm_name] = None
+                self.thermostats.append(therm_name)
+            sensor_name = "binary_sensor.window{}".format(room)
+            self.window_sensors.append(sensor_name)
+            self.rooms.append(room_name)
+            rooms[room_name] = {
+                "thermostats": thermostats,
+                "window_sensors": {sensor_name: None},
+                "reschedule_delay": 60,
+                "schedule": [
+                    {"temp": 21, "start": "06:00", "end": "08:00"},
+                    {"temp": 21, "start": "17:00", "end": "22:00",
+                     "weekdays": "1-5"},
+                    {"temp": 21, "start": "09:00", "end": "23:00",
+                     "weekdays": "6,7"},
+                ],
+            }
+        return {
+            "module": "heaty_app",
+            "class": "Heaty",
+            "schedule_append": [{"temp": 17}],
+            "rooms": rooms,
+        }
+
+    def record_latency(self, kind, name, seconds):
+        """Stores the latency of a callback."""
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def schedule_events(self, rate, callback):
+        """Schedules callback to run at random times according to a
+        Poisson process with the given rate per second."""
+
+        if rate <= 0:
+            return
+        offset = 0
+        while True:
+            offset += self.rng.expovariate(rate)
+            if offset >= self.args.duration:
+                break
+            self.app.run_in(callback, offset)
+
+    def drive_thermostat_update(self, kwargs):
+        """Simulates a thermostat reporting a new current temperature or,
+        sometimes, being adjusted manually."""
+
+        therm_name = self.rng.choice(self.thermostats)
+        attributes = {"current_temperature":
+                      round(self.rng.uniform(15, 23), 1)}
+        if self.rng.random() < self.args.manual_fraction:
+            attributes["temperature"] = self.rng.choice((18, 19, 20, 21, 22))
+        self.app.change_state(therm_name, attributes=attributes)
+
+    def drive_window_toggle(self, kwargs):
+        """Simulates a window being opened or closed."""
+
+        sensor_name = self.rng.choice(self.window_sensors)
+        state = self.app.states[sensor_name]["state"]
+        self.app.change_state(sensor_name, "off" if state == "on" else "on")
+
+    def drive_set_temp_event(self, kwargs):
+        """Simulates a heaty_set_temp event."""
+
+        self.app.fire_event("heaty_set_temp",
+                            room_name=self.rng.choice(self.rooms),
+                            temp=self.rng.choice((18, 19, 20, 21, 22)))
+
+    def run(self):
+        """Initializes the app, runs the simulation and returns the
+        report."""
+
+        self.app.initialize()
+        self.schedule_events(self.args.thermostat_rate,
+                             self.drive_thermostat_update)
+        self.schedule_events(self.args.window_rate, self.drive_window_toggle)
+        self.schedule_events(self.args.set_temp_rate, self.drive_set_temp_event)
+        # the harness' own timers would be measured as well otherwise
+        own = ("drive_thermostat_update", "drive_window_toggle",
+               "drive_set_temp_event")
+        self.app.run_until(
+            self.app.now + datetime.timedelta(seconds=self.args.duration)
+        )
+        for name in own:
+            self.latencies.pop(name, None)
+        return self.make_report()
+
+    def make_report(self):
+        """Returns a dict with the collected statistics."""
+
+        callbacks = {}
+        for name, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            callbacks[name] = {"count": len(values)}
+            for percentile in PERCENTILES:
+                index = min(len(values) - 1,
+                            int(len(values) * percentile / 100))
+                callbacks[name]["p{}".format(percentile)] = values[index]
+        return {
+            "callbacks": callbacks,
+            "api_calls": dict(self.app.counts),
+            "service_calls": dict(self.app.service_calls),
+            "io_time": self.app.io_time,
+            "warnings": sum(1 for _, _, msg in self.app.logs
+                          if msg.startswith("!!!")),
+        }
+
+
+def print_report(report):
+    """Prints the report in a human-readable format."""
+
+    print("{:<24} {:>8} {}".format(
+        "callback", "count",
+        " ".join("{:>10}".format("p{} ms".format(p)) for p in PERCENTILES)
+    ))
+    for name, stats in report["callbacks"].items():
+        print("{:<24} {:>8} {}".format(
+            name, stats["count"],
+            " ".join("{:>10.3f}".format(stats["p{}".format(p)] * 1000)
+                     for p in PERCENTILES)
+        ))
+    print()
+    for key in ("api_calls", "service_calls"):
+        for name, count in sorted(report[key].items()):
+            print("{:<40} {:>8}".format(name, count))
+    print("{:<40} {:>8.1f} s".format("simulated I/O time", report["io_time"]))
+    print("{:<40} {:>8}".format("logged warnings", report["warnings"]))
+
+def main():
+    """Parses the command line, runs the harness and prints the report."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--thermostats", type=int, default=2,
+                        help="number of thermostats per room")
+    parser.add_argument("--duration", type=float, default=3600,
+                        help="virtual seconds to simulate")
+    parser.add_argument("--thermostat-rate", type=float, default=10,
+                        help="thermostat attribute updates per second")
+    parser.add_argument("--manual-fraction", type=float, default=0.05,
+                        help="fraction of thermostat updates that change "
+                             "the target temperature")
+    parser.add_argument("--window-rate", type=float, default=0.2,
+                        help="window toggles per second")
+    parser.add_argument("--set-temp-rate", type=float, default=0.1,
+                        help="heaty_set_temp events per second")
+    parser.add_argument("--io-latency", type=float, default=0.005,
+                        help="simulated seconds per call to Home Assistant")
+    parser.add_argument("--ack-delay", type=float, default=1,
+                        help="seconds thermostats take to report commands "
+                             "back")
+    parser.add_argument("--drop-rate", type=float, default=0.02,
+                        help="fraction of commands thermostats lose")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--json", action="store_true",
+                        help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = LoadHarness(args).run()
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
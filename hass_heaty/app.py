@@ -4,17 +4,61 @@ that controls thermostats based on a schedule while still facilitating
 manual intervention at any time.
 """
 
+import bisect
+import collections
+import concurrent.futures
 import datetime
 import importlib
+import random
+import threading
+import time
 
 import appdaemon.appapi as appapi
 
-from . import __version__, config, expr, util
+from . import (
+    __version__, config, expr, metrics, profiler, simulate, trace, util
+)
 
 
 __all__ = ["Heaty"]
 
 
+# number of days to look ahead for changes in schedules at most
+SCHEDULE_LOOKAHEAD_DAYS = 7
+# commands due within this number of seconds are sent together
+SEND_COALESCE_SECONDS = 1
+# number of days the published heating plans cover
+PLAN_DAYS = 7
+# resolution of the plans while expressions depending on the time of
+# the day are in effect
+PLAN_STEP = datetime.timedelta(minutes=15)
+# plan updates requested within this number of seconds are computed
+# together
+PLAN_COALESCE_SECONDS = 10
+# re-schedule events received within this number of seconds are
+# handled together
+RESCHEDULE_COALESCE_SECONDS = 6
+# priorities of commands sent to thermostats, lower values go first
+PRIORITY_MANUAL = 0
+PRIORITY_SCHEDULED = 1
+# the interval between retries is multiplied by this with every retry
+RETRY_BACKOFF_FACTOR = 2
+# retry intervals are varied randomly by up to this fraction
+RETRY_JITTER = 0.2
+# maximum number of seconds between two retries
+RETRY_MAX_INTERVAL = 900
+# a thermostat is considered late when it took this many times its usual
+# acknowledgement latency to report a sent temperature back, but at least
+# ACK_TIMEOUT_MIN seconds
+ACK_TIMEOUT_FACTOR = 2
+ACK_TIMEOUT_MIN = 2
+# weight of a new sample when updating the learned acknowledgement latency
+ACK_LATENCY_WEIGHT = 0.3
+# reports arriving later than this many seconds after a command has been
+# sent aren't used to learn the acknowledgement latency
+ACK_LATENCY_MAX = 600
+
+
 class Heaty(appapi.AppDaemon):
     """The Heaty app class for AppDaemon."""
 
@@ -24,6 +68,32 @@ class Heaty(appapi.AppDaemon):
         super(Heaty, self).__init__(*args, **kwargs)
         self.cfg = None
         self.temp_expression_modules = {}
+        self.temp_expr_envs = {}
+        self.state_snapshot = None
+        self.entity_states = {}
+        self.send_queue = SendQueue()
+        self.send_timer = None
+        self.send_timer_due = None
+        self.eval_cycle = 0
+        self.reschedule_rooms = set()
+        # rooms to re-evaluate without forcing, see queue_reschedule
+        self.reevaluate_rooms = set()
+        self.reschedule_timer = None
+        self.plan_rooms = set()
+        self.plan_timer = None
+        self.metrics = metrics.Metrics()
+        self.trace = trace.Trace(0)
+        self.profiler = None
+        self.expr_executor = None
+        self.last_expr_results = {}
+        # (entity, attribute) tuples read by expressions, see
+        # update_dependencies
+        self.expr_reads = {}
+        self.dependent_rooms = {}
+        self.dependency_listeners = {}
+        # states read via state() during the current pass, see
+        # get_expr_state
+        self.expr_states = None
 
     def initialize(self):
         """Parses the configuration, initializes all timers, state and
@@ -36,6 +106,14 @@ class Heaty(appapi.AppDaemon):
 
         self.log("--- Parsing the configuration.")
         self.cfg = config.parse_config(self.args)
+        self.send_queue = SendQueue(self.cfg["service_rate_limits"])
+        self.trace = trace.Trace(self.cfg["trace_size"])
+        if self.cfg["profiler"]["enabled"]:
+            self.profiler = profiler.Profiler()
+        if self.cfg["temp_expression_timeout"]:
+            self.expr_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.cfg["temp_expression_workers"]
+            )
 
         heaty_id = self.cfg["heaty_id"]
         heaty_id_kwargs = {}
@@ -58,12 +136,43 @@ class Heaty(appapi.AppDaemon):
                 self.log("!!! Module won't be available.")
             else:
                 self.temp_expression_modules[as_name] = mod
+        self.temp_expr_envs = {}
+
+        self.log("--- Taking a snapshot of the current states.")
+        self.state_snapshot = self.take_state_snapshot()
+        try:
+            self.initialize_from_states(heaty_id_kwargs)
+        finally:
+            self.state_snapshot = None
+
+        self.log("--- Initialization done.")
+
+    def terminate(self):
+        """Is called by AppDaemon when the app is stopped or reloaded.
+        Expressions which are still running aren't waited for."""
+
+        if self.expr_executor is not None:
+            self.expr_executor.shutdown(wait=False)
+            self.expr_executor = None
+
+    def initialize_from_states(self, heaty_id_kwargs):
+        """Does the part of the initialization that depends on the
+        states of entities. While this runs, these are usually read
+        from the state snapshot taken by initialize."""
+
+        # pylint: disable=too-many-branches
+
+        self.log("--- Reading states of master switch and window sensors.")
+        self.entity_states = {}
+        for room in self.cfg["rooms"].values():
+            room["open_windows"] = set()
+        self.sync_entity_states()
 
         self.log("--- Getting current temperatures from thermostats.")
         for room_name, room in self.cfg["rooms"].items():
             for therm_name in room["thermostats"]:
                 # fetch initial state from thermostats
-                state = self.get_state(therm_name, attribute="all")
+                state = self.read_state(therm_name, attribute="all")
                 if not state:
                     # unknown entity
                     self.log("!!! State for thermostat {} is None, "
@@ -87,29 +196,14 @@ class Heaty(appapi.AppDaemon):
                           **heaty_id_kwargs)
 
         if self.cfg["debug"]:
-            self.log("--- Creating schedule timers.")
-        for room_name, room in self.cfg["rooms"].items():
-            # we collect the times in a set first to avoid registering
-            # multiple timers for the same time
-            times = set()
-            for rule in room["schedule"].unfold():
-                for _time in (rule.start_time, rule.end_time):
-                    # run 1 second later to avoid race condition, probably
-                    # not needed, but it doesn't hurt either
-                    _time = datetime.datetime.combine(
-                        datetime.date.today(), _time
-                    )
-                    _time += datetime.timedelta(seconds=1)
-                    _time = _time.time()
-                    times.add(_time)
+            self.log("--- Registering event listener for heaty_dump_trace.")
+        self.listen_event(self.dump_trace_event_cb, "heaty_dump_trace",
+                          **heaty_id_kwargs)
 
-            # now register a timer for each time a rule starts or ends
-            for _time in times:
-                if self.cfg["debug"]:
-                    self.log("--- [{}] Registering timer at {}."
-                             .format(room["friendly_name"], _time))
-                self.run_daily(self.schedule_timer_cb, _time,
-                               room_name=room_name)
+        if self.cfg["debug"]:
+            self.log("--- Creating schedule timers.")
+        for room_name in self.cfg["rooms"]:
+            self.update_schedule_timer(room_name)
 
         if self.cfg["debug"]:
             self.log("--- Registering thermostat state listeners.")
@@ -136,9 +230,10 @@ class Heaty(appapi.AppDaemon):
 
         if self.master_switch_enabled():
             self.log("--- Setting initial temperatures where needed.")
-            for room_name in self.cfg["rooms"]:
-                if not self.check_for_open_window(room_name):
-                    self.set_scheduled_temp(room_name)
+            self.set_scheduled_temps([
+                room_name for room_name in self.cfg["rooms"]
+                if not self.check_for_open_window(room_name)
+            ])
         else:
             self.log("--- Master switch is off, setting no initial values.")
 
@@ -149,8 +244,60 @@ class Heaty(appapi.AppDaemon):
                          .format(master_switch))
             self.listen_state(self.master_switch_cb, master_switch)
 
-        self.log("--- Initialization done.")
-
+        interval = self.cfg["state_resync_interval"]
+        if interval:
+            if self.cfg["debug"]:
+                self.log("--- Re-syncing states every {} seconds."
+                         .format(interval))
+            self.run_every(
+                self.resync_states_cb,
+                self.datetime() + datetime.timedelta(seconds=interval),
+                interval
+            )
+
+        interval = self.cfg["reconcile_interval"]
+        if interval:
+            if self.cfg["debug"]:
+                self.log("--- Reconciling thermostats every {} seconds."
+                         .format(interval))
+            self.run_every(
+                self.reconcile_cb,
+                self.datetime() + datetime.timedelta(seconds=interval),
+                interval
+            )
+
+        metrics_cfg = self.cfg["metrics"]
+        if metrics_cfg["sensor"] or metrics_cfg["prometheus_file"]:
+            if self.cfg["debug"]:
+                self.log("--- Publishing metrics every {} seconds."
+                         .format(metrics_cfg["interval"]))
+            self.run_every(
+                self.publish_metrics_cb,
+                self.datetime() + datetime.timedelta(
+                    seconds=metrics_cfg["interval"]
+                ),
+                metrics_cfg["interval"]
+            )
+
+        profiler_cfg = self.cfg["profiler"]
+        if profiler_cfg["enabled"]:
+            self.log("--- Profiling temperature expressions, reporting every "
+                     "{} seconds.".format(profiler_cfg["interval"]))
+            self.run_every(
+                self.profiler_report_cb,
+                self.datetime() + datetime.timedelta(
+                    seconds=profiler_cfg["interval"]
+                ),
+                profiler_cfg["interval"]
+            )
+
+        if self.cfg["plan_sensor_prefix"]:
+            self.log("--- Publishing heating plans shortly.")
+            self.update_plans()
+            # move the plans' period forward every day
+            self.run_daily(self.update_plans_cb, datetime.time(0, 0))
+
+    @metrics.timed("heaty_callback_duration_seconds")
     def schedule_timer_cb(self, kwargs):
         """Is called whenever a schedule timer fires."""
 
@@ -160,9 +307,15 @@ class Heaty(appapi.AppDaemon):
         if self.cfg["debug"]:
             self.log("--- [{}] Schedule timer fired."
                      .format(room["friendly_name"]))
+        try:
+            del room["schedule_timer"]
+        except KeyError:
+            pass
 
         self.set_scheduled_temp(room_name)
+        self.update_schedule_timer(room_name)
 
+    @metrics.timed("heaty_callback_duration_seconds")
     def reschedule_timer_cb(self, kwargs):
         """Is called whenever a re-schedule timer fires."""
 
@@ -174,13 +327,16 @@ class Heaty(appapi.AppDaemon):
             del room["reschedule_timer"]
         except KeyError:
             pass
+        room.pop("reschedule_time", None)
 
         # invalidate cached temp/rule
         room["current_schedule_temp"] = None
         room["current_schedule_rule"] = None
 
         self.set_scheduled_temp(room_name)
+        self.update_plans([room_name])
 
+    @metrics.timed("heaty_callback_duration_seconds")
     def reschedule_event_cb(self, event, data, kwargs):
         """This callback executes when a heaty_reschedule event is received.
         data may contain a "room_name", which limits the re-scheduling
@@ -205,11 +361,74 @@ class Heaty(appapi.AppDaemon):
                  .format(", ".join(room_names)))
 
         for room_name in room_names:
-            # delay for 6 seconds to avoid re-scheduling multiple
-            # times if multiple events come in shortly
-            self.update_reschedule_timer(room_name, reschedule_delay=0.1,
-                                         force=True)
+            # the delayed re-scheduling replaces running re-schedule
+            # timers
+            self.cancel_reschedule_timer(room_name)
+        self.queue_reschedule(room_names)
+
+    def queue_reschedule(self, room_names, force=True):
+        """Re-schedules the given rooms after RESCHEDULE_COALESCE_SECONDS
+        seconds, together with all rooms queued until then.
+        If force is False, the scheduled temperature is only set when
+        it or the rule yielding it changed, which keeps manual changes
+        as long as the schedule's result stays the same."""
+
+        if force:
+            self.reschedule_rooms.update(room_names)
+        else:
+            self.reevaluate_rooms.update(room_names)
+        # delay to avoid re-scheduling multiple times if multiple
+        # events come in shortly, all of them are handled by one timer
+        if self.reschedule_timer is None:
+            self.reschedule_timer = self.run_in(
+                self.reschedule_cb, RESCHEDULE_COALESCE_SECONDS
+            )
+            self.metrics.inc("heaty_timers_started_total", "reschedule_all")
+
+    @metrics.timed("heaty_callback_duration_seconds")
+    def reschedule_cb(self, kwargs):
+        """Is called when the timer started by reschedule_event_cb
+        fires and re-schedules all rooms events have been received
+        for in a single pass."""
+
+        room_names = self.reschedule_rooms | self.reevaluate_rooms
+        forced_room_names = self.reschedule_rooms
+        self.reschedule_rooms = set()
+        self.reevaluate_rooms = set()
+        self.reschedule_timer = None
+
+        for room_name in forced_room_names:
+            room = self.cfg["rooms"][room_name]
+            # invalidate cached temp/rule
+            room["current_schedule_temp"] = None
+            room["current_schedule_rule"] = None
+
+        self.set_scheduled_temps(room_names)
+        self.update_plans(room_names)
+
+    @metrics.timed("heaty_callback_duration_seconds")
+    def dependency_state_cb(self, entity, attr, old, new, kwargs):
+        """Is called when the state of an entity temperature expressions
+        read changed. The rooms whose schedules depend on it are
+        re-scheduled, see update_dependencies."""
+
+        dependency = kwargs["dependency"]
+        room_names = self.dependent_rooms.get(dependency)
+        if not room_names or not self.master_switch_enabled():
+            return
 
+        if self.cfg["debug"]:
+            self.log("--> {}: {} changed to {}, re-scheduling rooms: {}"
+                     .format(entity, attr, repr(new),
+                             ", ".join(sorted(room_names))))
+        for (rule, _), reads in self.expr_reads.items():
+            if dependency in reads:
+                rule.clear_cached_results()
+        for room_name in room_names:
+            self.record_trace(room_name, "dependency", entity, attr, new)
+        self.queue_reschedule(room_names, force=False)
+
+    @metrics.timed("heaty_callback_duration_seconds")
     def set_temp_event_cb(self, event, data, kwargs):
         """This callback executes when a heaty_set_temp event is received.
         data must contain a "room_name" and a "temp", which may also
@@ -252,6 +471,61 @@ class Heaty(appapi.AppDaemon):
                              force_resend=bool(data.get("force_resend")),
                              reschedule_delay=reschedule_delay)
 
+    @metrics.timed("heaty_callback_duration_seconds")
+    def dump_trace_event_cb(self, event, data, kwargs):
+        """This callback executes when a heaty_dump_trace event is
+        received. The recorded traces of the room given as "room_name"
+        or of all rooms are written to the log or, if configured, to
+        the trace_file."""
+
+        room_name = data.get("room_name")
+        if room_name is None:
+            room_names = sorted(self.cfg["rooms"])
+        elif room_name in self.cfg["rooms"]:
+            room_names = [room_name]
+        else:
+            self.log("!!! [{}] Ignoring heaty_dump_trace event for unknown "
+                     "room.".format(room_name))
+            return
+
+        self.log("--> heaty_dump_trace event received.")
+        self.dump_trace(room_names)
+
+    def record_trace(self, room_name, kind, *args):
+        """Records a decision made for the given room in the trace, see
+        hass_heaty.trace. Nothing is done when tracing is disabled."""
+
+        if not self.trace.size:
+            return
+        self.trace.record(room_name, self.datetime(), kind, *args)
+
+    def dump_trace(self, room_names):
+        """Writes the traces of the given rooms to the log or, if
+        configured, appends them to the trace_file."""
+
+        lines = []
+        for room_name in room_names:
+            friendly_name = self.cfg["rooms"][room_name]["friendly_name"]
+            lines.extend("--- [{}] {}".format(friendly_name, line)
+                         for line in self.trace.format_entries(room_name))
+
+        filename = self.cfg["trace_file"]
+        if not filename:
+            for line in lines:
+                self.log(line)
+            return
+
+        try:
+            with open(filename, "a") as fileobj:
+                fileobj.write("".join("{}\n".format(line) for line in lines))
+        except OSError as err:
+            self.log("!!! Error while writing the trace to {}: {}"
+                     .format(repr(filename), repr(err)))
+        else:
+            self.log("--- Wrote {} trace entries to {}."
+                     .format(len(lines), repr(filename)))
+
+    @metrics.timed("heaty_callback_duration_seconds")
     def thermostat_state_cb(self, entity, attr, old, new, kwargs):
         """Is called when a thermostat's state changes.
         This method fetches the set target temperature from the
@@ -262,28 +536,16 @@ class Heaty(appapi.AppDaemon):
         room = self.cfg["rooms"][room_name]
         therm = room["thermostats"][entity]
 
-        opmode = new.get("attributes", {}).get(therm["opmode_state_attr"])
-        if self.cfg["debug"]:
-            self.log("--> [{}] {}: attribute {} is {}"
-                     .format(room["friendly_name"], entity,
-                             therm["opmode_state_attr"], opmode))
-
-        if opmode is None:
+        temp = self.parse_thermostat_state(room_name, entity, new)
+        if temp is None:
             # don't consider this thermostat
             return
-        elif opmode == therm["opmode_off"]:
-            temp = expr.Temp("off")
-        else:
-            temp = new.get("attributes", {}).get(therm["temp_state_attr"])
-            if self.cfg["debug"]:
-                self.log("--> [{}] {}: attribute {} is {}"
-                         .format(room["friendly_name"], entity,
-                                 therm["temp_state_attr"], temp))
-            try:
-                temp = expr.Temp(temp) - therm["delta"]
-            except ValueError:
-                # not a valid temperature, don't consider this thermostat
-                return
+        self.record_trace(room_name, "report", entity, temp)
+
+        if temp == room["wanted_temp"]:
+            # thermostat adapted to the temperature we set,
+            # stop re-sending
+            self.confirm_send(room_name, entity)
 
         if temp == therm["current_temp"]:
             # nothing changed, hence no further actions needed
@@ -293,11 +555,6 @@ class Heaty(appapi.AppDaemon):
                  .format(room["friendly_name"], repr(temp)))
         therm["current_temp"] = temp
 
-        if temp == room["wanted_temp"]:
-            # thermostat adapted to the temperature we set,
-            # cancel any re-send timer
-            self.cancel_set_temp_timer(room_name, entity)
-
         if temp.is_off() and \
            isinstance(room["wanted_temp"], expr.Temp) and \
            isinstance(therm["min_temp"], expr.Temp) and \
@@ -316,6 +573,9 @@ class Heaty(appapi.AppDaemon):
             # replication.
             return
 
+        # the thermostat keeps the manual change, see reconcile_room
+        therm["wanted_temp"] = temp
+
         if len(room["thermostats"]) > 1 and \
            room["replicate_changes"] and self.master_switch_enabled():
             self.log("<-- [{}] Propagating the change to all thermostats "
@@ -325,29 +585,36 @@ class Heaty(appapi.AppDaemon):
             # just update the records
             room["wanted_temp"] = temp
 
-        # only re-schedule when no re-send timer is running and
+        # only re-schedule when no re-sending is pending and
         # re-scheduling is not disabled explicitly
-        if not therm.get("resend_timer") and not kwargs.get("no_reschedule"):
+        if entity not in self.send_queue and \
+           not kwargs.get("no_reschedule"):
             self.update_reschedule_timer(room_name)
 
+    @metrics.timed("heaty_callback_duration_seconds")
     def master_switch_cb(self, entity, attr, old, new, kwargs):
         """Is called when the master switch is toggled.
         If turned on, it sets the scheduled temperatures in all rooms.
         If switch is turned off, all re-schedule timers are cancelled
         and temperature is set to self.cfg["off_temp"] everywhere."""
 
+        self.entity_states[entity] = new
         self.log("--> Master switch turned {}.".format(new))
-        for room_name, room in self.cfg["rooms"].items():
-            if new == "on":
-                self.set_scheduled_temp(room_name)
-            else:
-                self.cancel_reschedule_timer(room_name)
-                self.set_temp(room_name, self.cfg["off_temp"],
-                              scheduled=False)
-                # invalidate cached temp/rule
-                room["current_schedule_temp"] = None
-                room["current_schedule_rule"] = None
+        if new == "on":
+            self.set_scheduled_temps()
+            self.update_plans()
+            return
 
+        self.cancel_pending_reschedule()
+        for room_name, room in self.cfg["rooms"].items():
+            self.cancel_reschedule_timer(room_name)
+            self.set_temp(room_name, self.cfg["off_temp"], scheduled=False)
+            # invalidate cached temp/rule
+            room["current_schedule_temp"] = None
+            room["current_schedule_rule"] = None
+        self.update_plans()
+
+    @metrics.timed("heaty_callback_duration_seconds")
     def window_sensor_cb(self, entity, attr, old, new, kwargs):
         """Is called when a window sensor's state has changed.
         This method handles the window open/closed detection and
@@ -355,8 +622,9 @@ class Heaty(appapi.AppDaemon):
 
         room_name = kwargs["room_name"]
         room = self.cfg["rooms"][room_name]
-        sensor = room["window_sensors"][entity]
-        action = "opened" if new == "on" or sensor["inverted"] else "closed"
+        self.set_window_state(room_name, entity, new)
+        action = "opened" if entity in room["open_windows"] else "closed"
+        self.record_trace(room_name, "window", entity, action)
         if self.cfg["debug"]:
             self.log("--> [{}] {}: state is now {}"
                      .format(room["friendly_name"], entity, new))
@@ -395,6 +663,9 @@ class Heaty(appapi.AppDaemon):
            not self.master_switch_enabled():
             return
 
+        for therm in room["thermostats"].values():
+            therm["wanted_temp"] = target_temp
+
         synced = all(map(lambda therm: target_temp == therm["current_temp"],
                          room["thermostats"].values()))
         if synced and not force_resend:
@@ -404,101 +675,272 @@ class Heaty(appapi.AppDaemon):
                  .format(room["friendly_name"], target_temp,
                          "scheduled" if scheduled else "manual"))
         room["wanted_temp"] = target_temp
+        self.record_trace(room_name, "set_temp", target_temp,
+                          "scheduled" if scheduled else "manual")
 
         for therm_name, therm in room["thermostats"].items():
             if target_temp == therm["current_temp"] and not force_resend:
+                self.record_trace(room_name, "redundant", target_temp,
+                                  therm_name)
                 if self.cfg["debug"]:
                     self.log("--- [{}] Not sending temperature to {} "
                              "redundantly."
                              .format(room["friendly_name"], therm_name))
                 continue
 
-            if target_temp.is_off():
-                temp = None
-                opmode = therm["opmode_off"]
+            opmode, temp = self.get_thermostat_target(therm, target_temp)
+            if scheduled:
+                priority = PRIORITY_SCHEDULED
             else:
-                temp = target_temp + therm["delta"]
-                if isinstance(therm["min_temp"], expr.Temp) and \
-                   temp < therm["min_temp"]:
-                    temp = None
-                    opmode = therm["opmode_off"]
-                else:
-                    opmode = therm["opmode_heat"]
-
-            left_retries = therm["set_temp_retries"]
-            self.cancel_set_temp_timer(room_name, therm_name)
-            timer = self.run_in(self.set_temp_resend_cb, 1,
-                                room_name=room_name, therm_name=therm_name,
-                                left_retries=left_retries,
-                                opmode=opmode, temp=temp)
-            therm["resend_timer"] = timer
-
-    def set_temp_resend_cb(self, kwargs):
-        """This callback sends the operation_mode and temperature to the
-        thermostat. Expected values for kwargs are:
-        - room_name and therm_name,
-        - opmode and temp (incl. delta)
-        - left_retries (after this round)"""
+                priority = PRIORITY_MANUAL
+            self.queue_send(room_name, therm_name, opmode, temp,
+                            therm["set_temp_retries"], 1, priority)
+
+    @staticmethod
+    def get_thermostat_target(therm, target_temp):
+        """Returns a tuple (opmode, temp) with the operation mode and
+        temperature (incl. delta) that have to be sent to the given
+        thermostat in order to set target_temp. temp is None if the
+        thermostat has to be turned off."""
+
+        if target_temp.is_off():
+            return therm["opmode_off"], None
+        temp = target_temp + therm["delta"]
+        if isinstance(therm["min_temp"], expr.Temp) and \
+           temp < therm["min_temp"]:
+            return therm["opmode_off"], None
+        return therm["opmode_heat"], temp
+
+    def parse_thermostat_state(self, room_name, therm_name, state):
+        """Returns the target temperature (excl. delta) the given
+        complete state of a thermostat reports or None, if it doesn't
+        report a valid one."""
 
-        room_name = kwargs["room_name"]
-        therm_name = kwargs["therm_name"]
-        opmode = kwargs["opmode"]
-        temp = kwargs["temp"]
-        left_retries = kwargs["left_retries"]
         room = self.cfg["rooms"][room_name]
         therm = room["thermostats"][therm_name]
+        attrs = state.get("attributes", {})
 
-        self.cancel_set_temp_timer(room_name, therm_name)
+        opmode = attrs.get(therm["opmode_state_attr"])
+        if self.cfg["debug"]:
+            self.log("--> [{}] {}: attribute {} is {}"
+                     .format(room["friendly_name"], therm_name,
+                             therm["opmode_state_attr"], opmode))
+        if opmode is None:
+            return None
+        if opmode == therm["opmode_off"]:
+            return expr.Temp("off")
 
+        temp = attrs.get(therm["temp_state_attr"])
         if self.cfg["debug"]:
-            self.log("<-- [{}] Setting {}: {}={}, {}={}, left retries={}"
+            self.log("--> [{}] {}: attribute {} is {}"
                      .format(room["friendly_name"], therm_name,
-                             therm["temp_service_attr"],
-                             temp if temp is not None else "<unset>",
-                             therm["opmode_service_attr"],
-                             opmode,
-                             left_retries))
-
-        attrs = {"entity_id": therm_name,
-                 therm["opmode_service_attr"]: opmode}
-        self.call_service(therm["opmode_service"], **attrs)
+                             therm["temp_state_attr"], temp))
+        try:
+            return expr.Temp(temp) - therm["delta"]
+        except ValueError:
+            # not a valid temperature
+            return None
+
+    def queue_send(self, room_name, therm_name, opmode, temp, left_retries,
+                   delay, priority):
+        """Queues the given operation mode and temperature (incl. delta)
+        for being sent to a thermostat in delay seconds, replacing any
+        command that is still pending for it. left_retries is the
+        number of times the command is re-sent afterwards.
+        See SendQueue for how commands are sent."""
+
+        # pylint: disable=too-many-arguments
+
+        self.record_trace(room_name, "queue", therm_name, opmode, temp)
+        therm = self.cfg["rooms"][room_name]["thermostats"][therm_name]
+        calls = [(therm["opmode_service"], therm["opmode_service_attr"],
+                  opmode)]
         if temp is not None:
-            attrs = {"entity_id": therm_name,
-                     therm["temp_service_attr"]: temp.value}
-            self.call_service(therm["temp_service"], **attrs)
+            calls.append((therm["temp_service"], therm["temp_service_attr"],
+                          temp.value))
 
-        if not left_retries:
+        self.send_queue.put(therm_name, {
+            "room_name": room_name,
+            "opmode": opmode,
+            "temp": temp,
+            "calls": calls,
+            "priority": priority,
+            "left_retries": left_retries,
+            "retry_interval": self.get_retry_interval(therm),
+            "due": self.datetime() + datetime.timedelta(seconds=delay),
+        })
+        self.update_send_timer()
+
+    @staticmethod
+    def get_retry_interval(therm):
+        """Returns the number of seconds to wait for the given thermostat
+        to report a sent temperature back before the first retry.
+        Once the thermostat's usual acknowledgement latency is known,
+        this is derived from it, set_temp_retry_interval is used
+        before."""
+
+        latency = therm.get("ack_latency")
+        if latency is None:
+            return therm["set_temp_retry_interval"]
+        return max(ACK_TIMEOUT_MIN, ACK_TIMEOUT_FACTOR * latency)
+
+    def confirm_send(self, room_name, therm_name):
+        """Is called when a thermostat reported the temperature that
+        has been sent to it. Pending retries are cancelled. If the
+        report can only be the answer to a single sending, the time it
+        took is used to learn the thermostat's acknowledgement latency,
+        even when no retries were left, see SendQueue.pop_sent_at."""
+
+        now = self.datetime()
+        sent_at = self.send_queue.pop_sent_at(therm_name, now)
+        cmd = self.send_queue.pop(therm_name)
+        if cmd is None and sent_at is None:
             return
+        self.metrics.inc("heaty_commands_confirmed_total")
+        self.record_trace(room_name, "confirm", therm_name)
+
+        room = self.cfg["rooms"][room_name]
+        therm = room["thermostats"][therm_name]
+        if sent_at is not None:
+            latency = (now - sent_at).total_seconds()
+            learned = therm.get("ack_latency")
+            if learned is not None:
+                latency = learned + ACK_LATENCY_WEIGHT * (latency - learned)
+            therm["ack_latency"] = latency
+
+        if self.cfg["debug"]:
+            self.log("--- [{}] {} confirmed the temperature, cancelling "
+                     "retries. Acknowledgement latency is {}."
+                     .format(room["friendly_name"], therm_name,
+                             therm.get("ack_latency")))
+
+    def update_send_timer(self):
+        """Makes sure the send timer fires when the next pending
+        command is due."""
+
+        due = self.send_queue.next_due()
+        if due is None:
+            return
+        if self.send_timer is not None:
+            if self.send_timer_due <= due:
+                # timer fires early enough
+                return
+            self.cancel_timer(self.send_timer)
+        now = self.datetime()
+        if due <= now:
+            due = now + datetime.timedelta(seconds=1)
+        self.send_timer = self.run_at(self.send_cb, due)
+        self.metrics.inc("heaty_timers_started_total", "send")
+        self.send_timer_due = due
+
+    @metrics.timed("heaty_callback_duration_seconds")
+    def send_cb(self, kwargs):
+        """Sends the commands of the send queue that are due."""
+
+        self.send_timer = None
+        self.send_timer_due = None
+
+        calls, sent = self.send_queue.pop_due(self.datetime())
+        for therm_name, cmd in sent:
+            if cmd.get("sends"):
+                self.metrics.inc("heaty_command_retries_total")
+            else:
+                self.metrics.inc("heaty_commands_sent_total")
 
-        interval = therm["set_temp_retry_interval"]
         if self.cfg["debug"]:
-            self.log("--- [{}] Re-sending to {} in {} seconds."
-                     .format(room["friendly_name"], therm_name, interval))
-        timer = self.run_in(self.set_temp_resend_cb, interval,
-                            room_name=room_name, therm_name=therm_name,
-                            left_retries=left_retries - 1,
-                            opmode=opmode, temp=temp)
-        therm["resend_timer"] = timer
-
-    def get_scheduled_temp(self, room_name):
+            for therm_name, cmd in sent:
+                room = self.cfg["rooms"][cmd["room_name"]]
+                therm = room["thermostats"][therm_name]
+                self.log("<-- [{}] Setting {}: {}={}, {}={}, left retries={}"
+                         .format(room["friendly_name"], therm_name,
+                                 therm["temp_service_attr"],
+                                 cmd["temp"] if cmd["temp"] is not None
+                                 else "<unset>",
+                                 therm["opmode_service_attr"],
+                                 cmd["opmode"],
+                                 cmd["left_retries"]))
+                if cmd["retry_in"] is not None:
+                    self.log("--- [{}] Re-sending to {} in {:.1f} seconds."
+                             .format(room["friendly_name"], therm_name,
+                                     cmd["retry_in"]))
+
+        for service, attr, value, therm_names in calls:
+            if len(therm_names) == 1:
+                entity_id = therm_names[0]
+            else:
+                entity_id = therm_names
+            self.call_service(service, **{"entity_id": entity_id,
+                                          attr: value})
+
+        self.update_send_timer()
+
+    def start_eval_cycle(self):
+        """Starts a new evaluation cycle and returns its id. Results of
+        rules that are shared by all rooms (e.g. from schedule_prepend)
+        and don't depend on room_name are computed only once per cycle
+        when the cycle id is passed to get_scheduled_temp."""
+
+        self.eval_cycle += 1
+        return self.eval_cycle
+
+    def get_scheduled_temp(self, room_name, cycle=None, reads=None):
         """Computes and returns the temperature that is configured for
         the current date and time in the given room. The second return
         value is the rule which generated the result.
         If no temperature could be found in the schedule (e.g. all
-        rules evaluate to Ignore()), None is returned."""
+        rules evaluate to Ignore()), None is returned.
+        cycle may be an id returned by start_eval_cycle.
+        reads may be a set, to which the (entity, attribute) tuples
+        read by the expressions of all rules that were considered are
+        added."""
 
         room = self.cfg["rooms"][room_name]
 
+        now = self.datetime()
         result_sum = expr.Add(0)
-        for rule in room["schedule"].get_matching_rules(self.datetime()):
-            result = self.eval_temp_expr(rule.temp_expr, room_name)
-            if self.cfg["debug"]:
-                self.log("--- [{}] Evaluated temperature expression {} "
-                         "to {}."
-                         .format(room["friendly_name"],
-                                 repr(rule.temp_expr_raw), result))
+        for rule in room["schedule"].get_matching_rules(now):
+            if reads is not None:
+                # expressions not using room_name read the same
+                # entities in every room
+                reads_key = (rule, room_name
+                             if "room_name" in rule.temp_expr_names
+                             else None)
+            result = rule.get_cached_result(room_name, now, cycle=cycle)
+            if result is None:
+                rule_reads = None if reads is None else set()
+                timed_out = False
+                try:
+                    result = self.eval_temp_expr(
+                        rule.temp_expr, room_name, now=now,
+                        temp_expr_raw=rule.temp_expr_raw, reads=rule_reads,
+                        raise_timeout=True, rule=rule
+                    )
+                except ExprTimeout as err:
+                    # a fallback must not be cached like a real result
+                    result = err.result
+                    timed_out = True
+                if rule_reads is not None:
+                    self.expr_reads[reads_key] = rule_reads
+                if result is not None and not timed_out:
+                    rule.cache_result(room_name, now, result, cycle=cycle)
+                    self.record_trace(room_name, "eval", rule, result)
+                if self.cfg["debug"]:
+                    self.log("--- [{}] Evaluated temperature expression {} "
+                             "to {}."
+                             .format(room["friendly_name"],
+                                     repr(rule.temp_expr_raw), result))
+            else:
+                self.record_trace(room_name, "cached", rule, result)
+                if self.cfg["debug"]:
+                    self.log("--- [{}] Using cached result {} of "
+                             "temperature expression {}."
+                             .format(room["friendly_name"], result,
+                                     repr(rule.temp_expr_raw)))
+            if reads is not None:
+                reads.update(self.expr_reads.get(reads_key, ()))
 
             if result is None:
+                self.record_trace(room_name, "eval_error", rule)
                 self.log("--- Skipping rule with faulty temperature "
                          "expression: {}"
                          .format(rule.temp_expr_raw))
@@ -506,6 +948,7 @@ class Heaty(appapi.AppDaemon):
 
             if isinstance(result, expr.Break):
                 # abort, don't change temperature
+                self.record_trace(room_name, "break", rule)
                 if self.cfg["debug"]:
                     self.log("--- [{}] Aborting scheduling due to Break()."
                              .format(room["friendly_name"]))
@@ -513,6 +956,7 @@ class Heaty(appapi.AppDaemon):
 
             if isinstance(result, expr.Ignore):
                 # skip this rule
+                self.record_trace(room_name, "ignore", rule)
                 if self.cfg["debug"]:
                     self.log("--- [{}] Skipping this rule."
                              .format(room["friendly_name"]))
@@ -521,9 +965,11 @@ class Heaty(appapi.AppDaemon):
             result_sum += result
 
             if isinstance(result_sum, expr.Result):
+                self.record_trace(room_name, "scheduled", result_sum.temp,
+                                  rule)
                 return result_sum.temp, rule
 
-    def set_scheduled_temp(self, room_name, force_resend=False):
+    def set_scheduled_temp(self, room_name, force_resend=False, cycle=None):
         """Sets the temperature that is configured for the current
         date and time in the given room. If the master switch is
         turned off, this won't do anything.
@@ -533,7 +979,8 @@ class Heaty(appapi.AppDaemon):
         and prevent re-setting the temperature in that case.
         If force_resend is True, and the temperature didn't
         change, it is sent to the thermostats anyway.
-        In case of an open window, temperature is cached and not sent."""
+        In case of an open window, temperature is cached and not sent.
+        cycle is passed on to get_scheduled_temp."""
 
         room = self.cfg["rooms"][room_name]
 
@@ -542,13 +989,20 @@ class Heaty(appapi.AppDaemon):
 
         if room.get("reschedule_timer"):
             # don't schedule now, wait for the timer instead
+            self.record_trace(room_name, "reschedule_pending")
             self.log("--- [{}] Not scheduling now due to a running "
                      "re-schedule timer."
                      .format(room["friendly_name"]))
             return
 
-        result = self.get_scheduled_temp(room_name)
+        reads = None
+        if self.cfg["watch_expression_entities"]:
+            reads = set()
+        result = self.get_scheduled_temp(room_name, cycle=cycle, reads=reads)
+        if reads is not None:
+            self.update_dependencies(room_name, reads)
         if result is None:
+            self.record_trace(room_name, "no_result")
             if self.cfg["debug"]:
                 self.log("--- [{}] No suitable temperature found in schedule."
                          .format(room["friendly_name"]))
@@ -561,12 +1015,14 @@ class Heaty(appapi.AppDaemon):
             # temp and rule didn't change, what means that the
             # re-scheduling wasn't necessary and was e.g. caused
             # by a daily timer which doesn't count for today
+            self.record_trace(room_name, "unchanged")
             return
 
         room["current_schedule_temp"] = temp
         room["current_schedule_rule"] = rule
 
         if self.get_open_windows(room_name):
+            self.record_trace(room_name, "window_open", temp)
             self.log("--- [{}] Caching and not setting temperature due "
                      "to an open window.".format(room["friendly_name"]))
             room["wanted_temp"] = temp
@@ -574,6 +1030,28 @@ class Heaty(appapi.AppDaemon):
             self.set_temp(room_name, temp, scheduled=True,
                           force_resend=force_resend)
 
+    def set_scheduled_temps(self, room_names=None):
+        """Sets the scheduled temperatures in the given rooms (all by
+        default) in a single pass. Results of rules shared by the rooms
+        are computed only once, see start_eval_cycle. States
+        expressions read via state() are fetched once per pass as well,
+        see get_expr_state. The pass itself reads no states from Home
+        Assistant, master switch and window sensors are taken from the
+        local mirror.
+        Commands for the thermostats are sent together, see
+        SendQueue."""
+
+        if room_names is None:
+            room_names = self.cfg["rooms"].keys()
+
+        cycle = self.start_eval_cycle()
+        expr_states, self.expr_states = self.expr_states, {}
+        try:
+            for room_name in room_names:
+                self.set_scheduled_temp(room_name, cycle=cycle)
+        finally:
+            self.expr_states = expr_states
+
     def set_manual_temp(self, room_name, temp_expr, force_resend=False,
                         reschedule_delay=None):
         """Sets the temperature in the given room. If the master switch
@@ -590,6 +1068,7 @@ class Heaty(appapi.AppDaemon):
 
         room = self.cfg["rooms"][room_name]
         result = self.eval_temp_expr(temp_expr, room_name)
+        self.record_trace(room_name, "manual", temp_expr, result)
         if self.cfg["debug"]:
             self.log("--- [{}] Evaluated temperature expression {} "
                      "to {}."
@@ -604,6 +1083,7 @@ class Heaty(appapi.AppDaemon):
         temp = result.temp
 
         if self.get_open_windows(room_name):
+            self.record_trace(room_name, "window_open", temp)
             self.log("--- [{}] Caching and not setting temperature due "
                      "to an open window.".format(room["friendly_name"]))
             room["wanted_temp"] = temp
@@ -613,31 +1093,183 @@ class Heaty(appapi.AppDaemon):
 
         self.update_reschedule_timer(room_name,
                                      reschedule_delay=reschedule_delay)
+        self.update_plans([room_name])
 
-    def eval_temp_expr(self, temp_expr, room_name):
+    def eval_temp_expr(self, temp_expr, room_name, now=None,
+                       temp_expr_raw=None, reads=None, raise_timeout=False,
+                       rule=None):
         """This is a wrapper around expr.eval_temp_expr that adds the
         app object, the room name  and some helpers to the evaluation
         environment, as well as all configured
         temp_expression_modules. It also catches and logs any
         exception which is raised during evaluation. In this case,
-        None is returned."""
-
-        # use date/time provided by appdaemon to support time-traveling
-        now = self.datetime()
-        extra_env = {
-            "app": self,
-            "room_name": room_name,
-            "now": now,
-            "date": now.date(),
-            "time": now.time(),
-        }
-        extra_env.update(self.temp_expression_modules)
-
+        None is returned. now may be given to evaluate at a specific
+        datetime instead of the current one.
+        temp_expr_raw is the expression's source the profiler records
+        the evaluation for, it defaults to temp_expr.
+        If temp_expression_timeout is set, expressions are evaluated by
+        a pool of threads, see eval_temp_expr_in_executor. When one
+        times out, the fallback result is returned or, if
+        raise_timeout is set, ExprTimeout is raised. rule may be the
+        schedule rule the expression belongs to, whose results are
+        remembered as the fallback for later timeouts.
+        If watch_expression_entities is set and reads is a set, the
+        (entity, attribute) tuples the expression reads via app are
+        added to it, see AppProxy."""
+
+        # pylint: disable=too-many-arguments
+
+        # AppDaemon runs callbacks in multiple threads, hence every
+        # thread gets environments of its own to set per-call values in
+        env = self.temp_expr_envs.get((threading.get_ident(), room_name))
+        if env is None:
+            env = self.build_temp_expr_env(room_name)
+
+        if now is None:
+            # use date/time provided by appdaemon to support time-traveling
+            now = self.datetime()
+        # modules take precedence over these names
+        for name, value in (("now", now), ("date", now.date()),
+                            ("time", now.time())):
+            if name not in self.temp_expression_modules:
+                env[name] = value
+
+        if temp_expr_raw is None:
+            temp_expr_raw = temp_expr
+        proxy = None
+        if reads is not None and self.cfg["watch_expression_entities"]:
+            # a proxy per evaluation, so that an expression still running
+            # after a timeout can't record into the reads of another one
+            proxy = AppProxy(self, reads)
+            env["app"] = proxy
+            env["state"] = proxy.get_expr_state
+
+        start = time.perf_counter()
+        failed = False
         try:
-            return expr.eval_temp_expr(temp_expr, extra_env=extra_env)
+            if self.expr_executor is not None and \
+               not isinstance(temp_expr, expr.Temp):
+                return self.eval_temp_expr_in_executor(
+                    temp_expr, room_name, env, temp_expr_raw, rule
+                )
+            return expr.eval_temp_expr(temp_expr, env=env)
+        except ExprTimeout as err:
+            if raise_timeout:
+                raise
+            return err.result
         except Exception as err:  # pylint: disable=broad-except
+            failed = True
+            self.metrics.inc("heaty_expr_errors_total")
             self.log("!!! Error while evaluating temperature expression: "
                      "{}".format(repr(err)))
+        finally:
+            if proxy is not None:
+                proxy.reads = None
+                # env is re-used by the next evaluation in this thread
+                env["app"] = self
+                env["state"] = self.get_expr_state
+            duration = time.perf_counter() - start
+            self.metrics.observe("heaty_expr_eval_duration_seconds", None,
+                                 duration)
+            if self.profiler is not None:
+                self.profiler.record(temp_expr_raw, room_name, duration,
+                                     failed)
+
+    def eval_temp_expr_in_executor(self, temp_expr, room_name, env,
+                                   temp_expr_raw, rule=None):
+        """Evaluates the given expression in a thread of expr_executor
+        and waits for temp_expression_timeout seconds at most. When the
+        expression takes longer, ExprTimeout is raised with the last
+        result of the given rule in the given room or, if there is none,
+        Ignore() as the fallback. The thread keeps running until the
+        expression finishes, but its result is discarded.
+        Results are only remembered for rules, since those are limited
+        by the configuration, unlike e.g. expressions of heaty_set_temp
+        events.
+        Exceptions raised by the expression are passed through."""
+
+        # pylint: disable=too-many-arguments
+
+        key = rule, room_name
+        # the expression could still be running when env is changed
+        # for the next evaluation, hence it gets a copy
+        future = self.expr_executor.submit(expr.eval_temp_expr, temp_expr,
+                                           env=dict(env))
+        try:
+            result = future.result(
+                timeout=self.cfg["temp_expression_timeout"]
+            )
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self.metrics.inc("heaty_expr_timeouts_total")
+            result = self.last_expr_results.get(key, expr.Ignore())
+            self.record_trace(room_name, "timeout", temp_expr_raw, result)
+            self.log("!!! [{}] Temperature expression {} timed out after {} "
+                     "seconds, using {} instead."
+                     .format(self.cfg["rooms"][room_name]["friendly_name"],
+                             repr(temp_expr_raw),
+                             self.cfg["temp_expression_timeout"],
+                             repr(result)))
+            raise ExprTimeout(result)
+
+        if rule is not None:
+            self.last_expr_results[key] = result
+        return result
+
+    def build_temp_expr_env(self, room_name):
+        """Builds the environment temperature expressions are evaluated
+        in for the given room and stores it for re-use by the current
+        thread. Values that change with every evaluation are set by
+        eval_temp_expr."""
+
+        env = expr.build_time_expression_env()
+        env["app"] = self
+        env["state"] = self.get_expr_state
+        env["room_name"] = room_name
+        env.update(self.temp_expression_modules)
+        self.temp_expr_envs[threading.get_ident(), room_name] = env
+        return env
+
+    def update_dependencies(self, room_name, reads):
+        """Stores the (entity, attribute) tuples the currently active
+        rules of the given room read as the room's dependencies and
+        listens for changes of those no other room depended on yet.
+        Listeners for entities no room depends on anymore are removed."""
+
+        room = self.cfg["rooms"][room_name]
+        old_reads = room.get("dependencies", frozenset())
+        if reads == old_reads:
+            return
+        room["dependencies"] = frozenset(reads)
+
+        for dependency in reads - old_reads:
+            self.dependent_rooms.setdefault(dependency, set()).add(room_name)
+            if dependency in self.dependency_listeners:
+                continue
+            entity, attribute = dependency
+            if self.cfg["debug"]:
+                self.log("--- [{}] Registering state listener for {}, "
+                         "attribute {}."
+                         .format(room["friendly_name"], entity, attribute))
+            kwargs = {}
+            if attribute is not None:
+                # AppDaemon only watches the state without attribute
+                kwargs["attribute"] = attribute
+            self.dependency_listeners[dependency] = self.listen_state(
+                self.dependency_state_cb, entity, dependency=dependency,
+                **kwargs
+            )
+
+        for dependency in old_reads - reads:
+            room_names = self.dependent_rooms[dependency]
+            room_names.discard(room_name)
+            if room_names:
+                continue
+            del self.dependent_rooms[dependency]
+            if self.cfg["debug"]:
+                self.log("--- Removing state listener for {}, attribute {}."
+                         .format(*dependency))
+            self.cancel_listen_state(self.dependency_listeners.pop(dependency))
 
     def update_reschedule_timer(self, room_name, reschedule_delay=None,
                                 force=False):
@@ -672,6 +1304,194 @@ class Heaty(appapi.AppDaemon):
         timer = self.run_at(self.reschedule_timer_cb, when,
                             room_name=room_name)
         room["reschedule_timer"] = timer
+        room["reschedule_time"] = when
+        self.metrics.inc("heaty_timers_started_total", "reschedule")
+        self.record_trace(room_name, "reschedule_timer", when)
+
+    def update_schedule_timer(self, room_name):
+        """Replaces the schedule timer of the given room by one that
+        fires when the set of rules matching in the room's schedule
+        changes next. If no such change is within reach, the timer
+        fires at midnight after the searched period in order to look
+        further ahead. When an expression in the schedule uses the
+        date, the timer fires at the next midnight at the latest."""
+
+        room = self.cfg["rooms"][room_name]
+        try:
+            self.cancel_timer(room.pop("schedule_timer"))
+        except KeyError:
+            pass
+
+        now = self.datetime()
+        when = room["schedule"].next_transition(
+            now, max_days=SCHEDULE_LOOKAHEAD_DAYS
+        )
+        if when is None:
+            when = datetime.datetime.combine(
+                now.date() + datetime.timedelta(
+                    days=SCHEDULE_LOOKAHEAD_DAYS + 1
+                ),
+                datetime.time(0, 0)
+            )
+        if any("date" in rule.temp_expr_names or
+               "datetime" in rule.temp_expr_names
+               for rule in room["schedule"].unfold()):
+            # the results of these may change with every new day
+            when = min(when, datetime.datetime.combine(
+                now.date() + datetime.timedelta(days=1), datetime.time(0, 0)
+            ))
+        # run 1 second later to avoid race condition, probably
+        # not needed, but it doesn't hurt either
+        when += datetime.timedelta(seconds=1)
+
+        if self.cfg["debug"]:
+            self.log("--- [{}] Registering schedule timer at {}."
+                     .format(room["friendly_name"], when))
+        timer = self.run_at(self.schedule_timer_cb, when,
+                            room_name=room_name)
+        room["schedule_timer"] = timer
+        self.metrics.inc("heaty_timers_started_total", "schedule")
+        self.record_trace(room_name, "schedule_timer", when)
+
+    def update_plans(self, room_names=None):
+        """Requests updating the heating plans of the given rooms (all
+        by default), if publishing plans is enabled. The plans are
+        computed PLAN_COALESCE_SECONDS seconds later, together with
+        those of all rooms requested until then, see plan_timer_cb."""
+
+        if not self.cfg["plan_sensor_prefix"]:
+            return
+        if room_names is None:
+            room_names = self.cfg["rooms"].keys()
+
+        self.plan_rooms.update(room_names)
+        if self.plan_timer is None:
+            self.plan_timer = self.run_in(self.plan_timer_cb,
+                                          PLAN_COALESCE_SECONDS)
+            self.metrics.inc("heaty_timers_started_total", "plan")
+
+    @metrics.timed("heaty_callback_duration_seconds")
+    def plan_timer_cb(self, kwargs):
+        """Computes the heating plans of the rooms requested via
+        update_plans for the next PLAN_DAYS days and publishes those
+        which changed. See get_plan."""
+
+        room_names = self.plan_rooms
+        self.plan_rooms = set()
+        self.plan_timer = None
+
+        # evaluate like when scheduling, with timeout and profiling
+        sim = simulate.Simulator(
+            self.cfg, app=self,
+            temp_expression_modules=self.temp_expression_modules,
+            step=PLAN_STEP,
+            evaluator=lambda rule, room_name, now: self.eval_temp_expr(
+                rule.temp_expr, room_name, now=now,
+                temp_expr_raw=rule.temp_expr_raw
+            )
+        )
+        for room_name in sorted(room_names):
+            self.publish_plan(room_name, self.get_plan(room_name, sim))
+
+    @metrics.timed("heaty_callback_duration_seconds")
+    def update_plans_cb(self, kwargs):
+        """Is called every day to move the plans' period forward."""
+        self.update_plans()
+
+    def get_plan(self, room_name, sim):
+        """Returns a list of simulate.Segment objects with the planned
+        temperatures in the given room for the next PLAN_DAYS days,
+        computed with the given simulate.Simulator. Temperatures set
+        manually are taken into account until the re-schedule timer
+        fires or, if there is none, until the schedule changes.
+        Expressions are evaluated with the current states of
+        entities."""
+
+        room = self.cfg["rooms"][room_name]
+        now = self.datetime().replace(second=0, microsecond=0)
+        end = now + datetime.timedelta(days=PLAN_DAYS)
+
+        if not self.master_switch_enabled():
+            return [simulate.Segment(room_name, now, end,
+                                     self.cfg["off_temp"])]
+
+        segments = sim.simulate_room(room_name, now, end)
+        wanted = room["wanted_temp"]
+        if wanted is None or wanted == segments[0].temp:
+            return segments
+
+        until = room.get("reschedule_time")
+        if until is None:
+            until = room["schedule"].next_transition(
+                now, max_days=PLAN_DAYS
+            ) or end
+        plan = [simulate.Segment(room_name, now, until, wanted)]
+        for seg in segments:
+            if seg.end > until:
+                plan.append(seg._replace(start=max(seg.start, until)))
+        return plan
+
+    def publish_plan(self, room_name, plan):
+        """Publishes the given plan of a room as the state of a sensor,
+        unless it didn't change since it was published last.
+        The sensor's state is the currently planned temperature, which
+        is updated whenever the next planned temperature starts. Its
+        plan attribute is a list of dicts with the keys start (ISO 8601
+        string) and temp (a number, "off" or None if unknown), one for
+        every change of the temperature."""
+
+        room = self.cfg["rooms"][room_name]
+        points = []
+        for seg in plan:
+            temp = seg.temp
+            if temp is not None:
+                temp = temp.value
+            points.append({"start": seg.start.isoformat(), "temp": temp})
+        if points == room.get("published_plan"):
+            return
+        room["published_plan"] = points
+        room["published_plan_starts"] = [seg.start for seg in plan]
+
+        if self.cfg["debug"]:
+            self.log("<-- [{}] Publishing plan with {} change points."
+                     .format(room["friendly_name"], len(points)))
+        self.publish_plan_state(room_name)
+
+    def publish_plan_state(self, room_name):
+        """Sets the state of the given room's plan sensor to the
+        temperature of the published plan that is planned for now and
+        starts a timer for doing so again when the next planned
+        temperature starts."""
+
+        room = self.cfg["rooms"][room_name]
+        points = room["published_plan"]
+        starts = room["published_plan_starts"]
+        index = max(0, bisect.bisect_right(starts, self.datetime()) - 1)
+
+        entity = "{}_{}".format(self.cfg["plan_sensor_prefix"],
+                                util.escape_object_id(room_name))
+        self.set_state(entity, state=points[index]["temp"], attributes={
+            "friendly_name": "{} plan".format(room["friendly_name"]),
+            "plan": points,
+        })
+
+        timer = room.pop("plan_state_timer", None)
+        if timer is not None:
+            self.cancel_timer(timer)
+        if index + 1 < len(starts):
+            room["plan_state_timer"] = self.run_at(
+                self.plan_state_cb, starts[index + 1], room_name=room_name
+            )
+            self.metrics.inc("heaty_timers_started_total", "plan_state")
+
+    @metrics.timed("heaty_callback_duration_seconds")
+    def plan_state_cb(self, kwargs):
+        """Is called when the next temperature of a published plan
+        starts and updates the state of the plan sensor."""
+
+        room_name = kwargs["room_name"]
+        self.cfg["rooms"][room_name].pop("plan_state_timer", None)
+        self.publish_plan_state(room_name)
 
     def cancel_reschedule_timer(self, room_name):
         """Cancels the reschedule timer for the given room, if one
@@ -680,31 +1500,38 @@ class Heaty(appapi.AppDaemon):
 
         room = self.cfg["rooms"][room_name]
 
+        room.pop("reschedule_time", None)
         try:
             timer = room.pop("reschedule_timer")
         except KeyError:
             return False
 
+        self.record_trace(room_name, "cancel_reschedule_timer")
         if self.cfg["debug"]:
             self.log("--- [{}] Cancelling re-schedule timer."
                      .format(room["friendly_name"]))
         self.cancel_timer(timer)
         return True
 
+    def cancel_pending_reschedule(self):
+        """Cancels the re-scheduling of rooms that is pending due to
+        heaty_reschedule events, if any."""
+
+        self.reschedule_rooms = set()
+        self.reevaluate_rooms = set()
+        if self.reschedule_timer is not None:
+            if self.cfg["debug"]:
+                self.log("--- Cancelling pending re-scheduling.")
+            self.cancel_timer(self.reschedule_timer)
+            self.reschedule_timer = None
+
     def cancel_set_temp_timer(self, room_name, therm_name):
-        """Cancel the set temp timer for given room and thermostat name,
+        """Cancel the pending command for given room and thermostat name,
         if one exists."""
-        room = self.cfg["rooms"][room_name]
-        therm = room["thermostats"][therm_name]
-        try:
-            timer = therm.pop("resend_timer")
-        except KeyError:
-            pass
-        else:
-            if self.cfg["debug"]:
-                self.log("--- [{}] Cancelling retry timer for {}."
-                         .format(room["friendly_name"], therm_name))
-            self.cancel_timer(timer)
+        if self.send_queue.remove(therm_name) and self.cfg["debug"]:
+            room = self.cfg["rooms"][room_name]
+            self.log("--- [{}] Cancelling retries for {}."
+                     .format(room["friendly_name"], therm_name))
 
     def check_for_open_window(self, room_name):
         """Checks whether a window is open in the given room and,
@@ -726,20 +1553,509 @@ class Heaty(appapi.AppDaemon):
             return True
         return False
 
+    def get_referenced_entities(self):
+        """Returns a set with the names of all entities Heaty reads the
+        states of, namely thermostats, window sensors and the master
+        switch."""
+
+        entities = set()
+        for room in self.cfg["rooms"].values():
+            entities.update(room["thermostats"])
+            entities.update(room["window_sensors"])
+        if self.cfg["master_switch"]:
+            entities.add(self.cfg["master_switch"])
+        return entities
+
+    def take_state_snapshot(self):
+        """Fetches the states of all entities from Home Assistant at once
+        and returns a dict mapping the names of referenced entities to
+        their complete states, as returned by
+        get_state(entity, attribute="all"). Entities without a state
+        are left out. If the states can't be fetched, None is
+        returned."""
+
+        states = self.get_state()
+        if not isinstance(states, dict):
+            self.log("!!! Couldn't fetch the states of all entities at "
+                     "once, fetching them one by one instead.")
+            return None
+        return {entity: states[entity]
+                for entity in self.get_referenced_entities()
+                if entity in states}
+
+    def read_state(self, entity, attribute=None):
+        """Works like get_state, but reads from self.state_snapshot
+        instead of querying Home Assistant, if a snapshot is active."""
+
+        snapshot = self.state_snapshot
+        if snapshot is None:
+            return self.get_state(entity, attribute=attribute)
+        return get_state_value(snapshot.get(entity), attribute)
+
+    def get_expr_state(self, entity, attribute=None):
+        """Is available as state() inside of temperature expressions and
+        works like get_state. During a pass over multiple rooms (see
+        set_scheduled_temps), the state of every entity is fetched only
+        once and re-used for all further reads in that pass. Entities
+        contained in an active state snapshot aren't fetched at all."""
+
+        states = self.expr_states
+        if states is None:
+            return self.read_state(entity, attribute=attribute)
+        try:
+            state = states[entity]
+        except KeyError:
+            state = None
+            if self.state_snapshot is not None:
+                state = self.state_snapshot.get(entity)
+            if state is None:
+                state = self.get_state(entity, attribute="all")
+            states[entity] = state
+        return get_state_value(state, attribute)
+
+    def set_window_state(self, room_name, sensor_name, state):
+        """Stores the given state of a window sensor in the local mirror
+        and updates the set of open windows of its room."""
+
+        room = self.cfg["rooms"][room_name]
+        sensor = room["window_sensors"][sensor_name]
+        self.entity_states[sensor_name] = state
+        if state == "on" or sensor["inverted"]:
+            room["open_windows"].add(sensor_name)
+        else:
+            room["open_windows"].discard(sensor_name)
+
+    def sync_entity_states(self, keep_delayed=False):
+        """Reads the states of the master switch and all window sensors
+        and stores them in the local mirror. A list of
+        (entity, room_name, old_state, new_state) tuples is returned
+        for every entity whose state differed from the mirrored one.
+        room_name is None for the master switch.
+        If keep_delayed is set, changed states of window sensors with a
+        delay aren't stored, but only returned."""
+
+        changes = []
+        master_switch = self.cfg["master_switch"]
+        if master_switch:
+            old = self.entity_states.get(master_switch)
+            new = self.read_state(master_switch)
+            self.entity_states[master_switch] = new
+            if new != old:
+                changes.append((master_switch, None, old, new))
+        for room_name, room in self.cfg["rooms"].items():
+            for sensor_name in room["window_sensors"]:
+                old = self.entity_states.get(sensor_name)
+                new = self.read_state(sensor_name)
+                if new == old:
+                    continue
+                changes.append((sensor_name, room_name, old, new))
+                if not keep_delayed or \
+                   not room["window_sensors"][sensor_name]["delay"]:
+                    self.set_window_state(room_name, sensor_name, new)
+        return changes
+
+    @metrics.timed("heaty_callback_duration_seconds")
+    def resync_states_cb(self, kwargs):
+        """Is called periodically to correct the mirrored states of the
+        master switch and window sensors, in case a state change has
+        been missed. For changed entities, the regular state callbacks
+        are run."""
+
+        self.state_snapshot = self.take_state_snapshot()
+        try:
+            changes = self.sync_entity_states(keep_delayed=True)
+        finally:
+            self.state_snapshot = None
+
+        for entity, room_name, old, new in changes:
+            if room_name is not None:
+                delay = self.cfg["rooms"][room_name]["window_sensors"] \
+                        [entity]["delay"]
+                if delay:
+                    # the change might just not have lasted for the
+                    # sensor's delay yet, check again after it
+                    self.run_in(self.resync_window_cb, delay,
+                                room_name=room_name, entity=entity,
+                                old=old, new=new)
+                    self.metrics.inc("heaty_timers_started_total",
+                                     "resync_window")
+                    continue
+            self.log("!!! State of {} was {}, but actually is {}, "
+                     "correcting.".format(entity, repr(old), repr(new)))
+            if room_name is None:
+                self.master_switch_cb(entity, "state", old, new, {})
+            else:
+                self.window_sensor_cb(entity, "state", old, new,
+                                      {"room_name": room_name})
+
+    @metrics.timed("heaty_callback_duration_seconds")
+    def resync_window_cb(self, kwargs):
+        """Is called the delay of a window sensor after resync_states_cb
+        found its state to differ from the mirrored one. If the state
+        still is the same and the regular state listener didn't handle
+        it in the meantime, the change is handled now."""
+
+        entity = kwargs["entity"]
+        new = kwargs["new"]
+        if self.entity_states.get(entity) == new or \
+           self.get_state(entity) != new:
+            return
+        self.log("!!! State of {} was {}, but actually is {}, "
+                 "correcting.".format(entity, repr(kwargs["old"]),
+                                      repr(new)))
+        self.window_sensor_cb(entity, "state", kwargs["old"], new,
+                              {"room_name": kwargs["room_name"]})
+
+    @metrics.timed("heaty_callback_duration_seconds")
+    def reconcile_cb(self, kwargs):
+        """Is called periodically to compare the temperatures reported
+        by all thermostats with the wanted ones. Commands are queued
+        for every thermostat that diverges and has nothing pending
+        already, e.g. because a command got lost after all retries.
+        Nothing is done while the master switch is off."""
+
+        if not self.master_switch_enabled():
+            return
+
+        self.state_snapshot = self.take_state_snapshot()
+        try:
+            for room_name in self.cfg["rooms"]:
+                self.reconcile_room(room_name)
+        finally:
+            self.state_snapshot = None
+
+    def reconcile_room(self, room_name):
+        """Queues commands for all thermostats of the given room whose
+        reported temperature differs from the one wanted for them. That
+        is the temperature Heaty set last or, if a manual change at the
+        thermostat was accepted afterwards, the one it reported then.
+        See reconcile_cb."""
+
+        room = self.cfg["rooms"][room_name]
+        for therm_name, therm in room["thermostats"].items():
+            wanted = therm["wanted_temp"]
+            if wanted is None or therm_name in self.send_queue:
+                # nothing has been set yet or a command is pending
+                continue
+            state = self.read_state(therm_name, attribute="all")
+            if not state:
+                continue
+            temp = self.parse_thermostat_state(room_name, therm_name, state)
+            if temp is None:
+                continue
+            opmode, target = self.get_thermostat_target(therm, wanted)
+            if temp == wanted or target is None and temp.is_off():
+                continue
+
+            self.log("!!! [{}] {} reports {}, but {} is wanted, re-sending."
+                     .format(room["friendly_name"], therm_name, repr(temp),
+                             repr(wanted)))
+            therm["current_temp"] = temp
+            self.queue_send(room_name, therm_name, opmode, target,
+                            therm["set_temp_retries"], 1,
+                            PRIORITY_SCHEDULED)
+
+    @metrics.timed("heaty_api_call_duration_seconds")
+    def get_state(self, *args, **kwargs):
+        """Wraps AppDaemon's get_state in order to record metrics."""
+        return super(Heaty, self).get_state(*args, **kwargs)
+
+    @metrics.timed("heaty_api_call_duration_seconds")
+    def call_service(self, *args, **kwargs):
+        """Wraps AppDaemon's call_service in order to record metrics."""
+        return super(Heaty, self).call_service(*args, **kwargs)
+
+    def publish_metrics_cb(self, kwargs):
+        """Is called periodically to publish the collected metrics as
+        the state of a sensor and/or write them to a file in the text
+        format of Prometheus, depending on the configuration."""
+
+        metrics_cfg = self.cfg["metrics"]
+        if metrics_cfg["sensor"]:
+            summary = self.metrics.get_summary()
+            calls = sum(value for key, value in summary.items()
+                        if key.startswith("callback_duration_") and
+                        key.endswith("_count"))
+            self.set_state(metrics_cfg["sensor"], state=calls,
+                           attributes=summary)
+        if metrics_cfg["prometheus_file"]:
+            try:
+                self.metrics.write_prometheus(metrics_cfg["prometheus_file"])
+            except OSError as err:
+                self.log("!!! Couldn't write metrics to {}: {}"
+                         .format(metrics_cfg["prometheus_file"], repr(err)))
+
+    @metrics.timed("heaty_callback_duration_seconds")
+    def profiler_report_cb(self, kwargs):
+        """Is called periodically to log the temperature expressions
+        which were the most expensive to evaluate."""
+
+        profiler_cfg = self.cfg["profiler"]
+        lines = self.profiler.format_report(profiler_cfg["top"],
+                                            profiler_cfg["sort_by"])
+        self.log("--- Top {} temperature expressions by {}:"
+                 .format(len(lines), profiler_cfg["sort_by"]))
+        for line in lines:
+            self.log("--- {}".format(line))
+        if profiler_cfg["reset"]:
+            self.profiler.reset()
+
     def master_switch_enabled(self):
         """Returns the state of the master switch or True if no master
         switch is configured."""
         master_switch = self.cfg["master_switch"]
         if master_switch:
-            return self.get_state(master_switch) == "on"
+            return self.entity_states.get(master_switch) == "on"
         return True
 
     def get_open_windows(self, room_name):
         """Returns a list of windo sensors in the given room which
         currently report to be open,"""
-        open_sensors = []
-        sensors = self.cfg["rooms"][room_name]["window_sensors"]
-        for sensor_name, sensor in sensors.items():
-            if self.get_state(sensor_name) == "on" or sensor["inverted"]:
-                open_sensors.append(sensor_name)
-        return open_sensors
+        return list(self.cfg["rooms"][room_name]["open_windows"])
+
+
+class ExprTimeout(Exception):
+    """Raised when the evaluation of a temperature expression timed
+    out. result is the fallback result to use instead."""
+
+    def __init__(self, result):
+        super(ExprTimeout, self).__init__(result)
+        self.result = result
+
+
+class AppProxy:
+    """Is made available as app to temperature expressions instead of
+    the app itself when watch_expression_entities is set and the reads
+    of an evaluation are tracked. Everything is passed through to the
+    app, but while reads is a set, the (entity, attribute) tuples of
+    all states read via get_state are added to it."""
+
+    def __init__(self, app, reads=None):
+        self.app = app
+        self.reads = reads
+
+    def __getattr__(self, name):
+        return getattr(self.app, name)
+
+    def get_state(self, entity_id=None, attribute=None, *args, **kwargs):
+        """Works like AppDaemon's get_state and records the read.
+        Reading the states of all entities at once isn't recorded.
+        Further arguments are passed through unchanged."""
+
+        # pylint: disable=keyword-arg-before-vararg
+
+        reads = self.reads
+        if reads is not None and entity_id is not None:
+            reads.add((entity_id, attribute))
+        return self.app.get_state(entity_id, attribute, *args, **kwargs)
+
+    def get_expr_state(self, entity, attribute=None):
+        """Works like Heaty.get_expr_state and records the read."""
+
+        reads = self.reads
+        if reads is not None:
+            reads.add((entity, attribute))
+        return self.app.get_expr_state(entity, attribute)
+
+
+def get_state_value(state, attribute=None):
+    """Returns the given attribute of a complete state as returned by
+    get_state(entity, attribute="all"), the state's value if attribute
+    is None or the whole state if attribute is "all". None is returned
+    if there is no state."""
+
+    if state is None or attribute == "all":
+        return state
+    if attribute is None:
+        return state.get("state")
+    if attribute in state:
+        return state[attribute]
+    return state.get("attributes", {}).get(attribute)
+
+
+def get_retry_delay(interval, sends):
+    """Returns the number of seconds to wait before re-sending a command
+    that has already been sent sends times, with interval being the
+    delay before the first retry. The delay grows exponentially and
+    is varied randomly to spread retries of multiple thermostats."""
+
+    delay = interval * RETRY_BACKOFF_FACTOR ** (sends - 1)
+    delay *= random.uniform(1 - RETRY_JITTER, 1 + RETRY_JITTER)
+    return min(delay, RETRY_MAX_INTERVAL)
+
+
+class TokenBucket:
+    """A token bucket that limits the rate of some action to rate per
+    second, while allowing bursts of up to burst actions."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = None
+
+    def refill(self, now):
+        """Adds the tokens earned since the last refill."""
+
+        if self.updated is not None:
+            elapsed = (now - self.updated).total_seconds()
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def get_wait_time(self, now, count=1):
+        """Returns the number of seconds to wait until count tokens are
+        available, which is 0 if they are available now. More than
+        burst tokens can never be available, hence a larger count only
+        waits for a full bucket. take() then leaves the bucket in debt,
+        which delays the following actions accordingly."""
+
+        self.refill(now)
+        count = min(count, self.burst)
+        if self.tokens >= count:
+            return 0
+        return (count - self.tokens) / self.rate
+
+    def take(self, now, count=1):
+        """Takes count tokens from the bucket. Use get_wait_time to check
+        whether they're available first. The number of tokens may get
+        negative."""
+
+        self.refill(now)
+        self.tokens -= count
+
+
+class SendQueue:
+    """The central queue for commands sent to thermostats.
+
+    Commands are dicts which contain at least the keys "calls", a list
+    of (service, attribute, value) tuples that are made in order,
+    "priority", "due", "left_retries" and "retry_interval". While
+    retries are left, a command is re-sent after its retry_interval,
+    which then doubles with every further retry (see get_retry_delay).
+    The number of sendings is stored as "sends". There is
+    at most one pending command per thermostat, so a newer command
+    replaces the older one and only the latest target is ever sent.
+    Independent of pending retries, the time a thermostat's latest
+    command has been sent at is remembered until it is acknowledged,
+    see pop_sent_at.
+
+    Due commands are sent in order of their priority. Calls of multiple
+    thermostats with equal service, attribute and value are merged
+    into one call with a list of entity ids. The number of calls per
+    service can be limited by token buckets. Commands for which no
+    tokens are available are postponed until tokens are available
+    again."""
+
+    def __init__(self, rate_limits=None):
+        self.commands = {}
+        self.sent_at = {}
+        self.buckets = {}
+        for service, limit in (rate_limits or {}).items():
+            self.buckets[service] = TokenBucket(limit["rate"], limit["burst"])
+
+    def __contains__(self, therm_name):
+        return therm_name in self.commands
+
+    def put(self, therm_name, cmd):
+        """Queues the given command, replacing a pending one for the same
+        thermostat."""
+
+        self.commands[therm_name] = cmd
+        # acknowledgements are expected for the new command only
+        self.sent_at.pop(therm_name, None)
+
+    def pop(self, therm_name):
+        """Removes the command pending for the given thermostat and
+        returns it. If there is none, None is returned."""
+
+        return self.commands.pop(therm_name, None)
+
+    def remove(self, therm_name):
+        """Removes the command pending for the given thermostat. Returns
+        True if there was one, False otherwise."""
+
+        self.sent_at.pop(therm_name, None)
+        return self.pop(therm_name) is not None
+
+    def pop_sent_at(self, therm_name, now):
+        """Returns the datetime the latest command for the given
+        thermostat has been sent at and forgets it. None is returned if
+        the command hasn't been sent exactly once or if it has been sent
+        more than ACK_LATENCY_MAX seconds before the given datetime, in
+        which cases an acknowledgement can't be attributed to a single
+        sending."""
+
+        sent_at = self.sent_at.pop(therm_name, None)
+        if sent_at is None or \
+           (now - sent_at).total_seconds() > ACK_LATENCY_MAX:
+            return None
+        return sent_at
+
+    def next_due(self):
+        """Returns the datetime the next command is due at or None, if
+        the queue is empty."""
+
+        if not self.commands:
+            return None
+        return min(cmd["due"] for cmd in self.commands.values())
+
+    def pop_due(self, now):
+        """Takes the commands which are due at the given datetime out of
+        the queue, or re-queues them if they have retries left.
+        Returns a tuple (calls, sent). calls is a list of
+        (service, attribute, value, thermostat_names) tuples for the
+        service calls to make, in order. sent is a list of
+        (therm_name, cmd) tuples, with the commands as they were before
+        being sent."""
+
+        limit = now + datetime.timedelta(seconds=SEND_COALESCE_SECONDS)
+        due = sorted(
+            (item for item in self.commands.items()
+             if item[1]["due"] <= limit),
+            key=lambda item: (item[1]["priority"], item[1]["due"])
+        )
+
+        stages = []
+        sent = []
+        for therm_name, cmd in due:
+            while len(stages) < len(cmd["calls"]):
+                stages.append(collections.OrderedDict())
+
+            # count the new service calls this command would cause
+            counts = collections.Counter(
+                call[0] for stage, call in zip(stages, cmd["calls"])
+                if call not in stage
+            )
+            wait = max([self.buckets[service].get_wait_time(now, count)
+                        for service, count in counts.items()
+                        if service in self.buckets] or [0])
+            if wait:
+                # try again when the rate limit permits
+                cmd["due"] = now + datetime.timedelta(seconds=wait)
+                continue
+
+            for service, count in counts.items():
+                if service in self.buckets:
+                    self.buckets[service].take(now, count)
+            for stage, call in zip(stages, cmd["calls"]):
+                stage.setdefault(call, []).append(therm_name)
+            sent.append((therm_name, dict(cmd)))
+
+            cmd["sends"] = cmd.get("sends", 0) + 1
+            if cmd["sends"] == 1:
+                self.sent_at[therm_name] = now
+            else:
+                self.sent_at.pop(therm_name, None)
+            if cmd["left_retries"]:
+                retry_in = get_retry_delay(cmd["retry_interval"],
+                                           cmd["sends"])
+                cmd["left_retries"] -= 1
+                cmd["due"] = now + datetime.timedelta(seconds=retry_in)
+            else:
+                retry_in = None
+                del self.commands[therm_name]
+            sent[-1][1]["retry_in"] = retry_in
+
+        calls = [call + (therm_names,)
+                 for stage in stages for call, therm_names in stage.items()]
+        return calls, sent
@@ -16,13 +16,15 @@ SCHEMA_FILE = os.path.join(
     os.path.dirname(__file__), "data", "config_schema.json"
 )
 # all constraints that have values in the range_string format
-# (see util.expand_range_string)
+# (see util.parse_range_string)
 RANGE_STRING_CONSTRAINTS = ("years", "months", "days", "weeks", "weekdays")
 
 
 def extend_with_default(validator_class):
-    """This extends the given validator class with two special validator
-    functions in order to provide automatic setting of default values."""
+    """This extends the given validator class with a special validator
+    function in order to provide automatic setting of default values.
+    Schemas have to be passed through resolve_refs first, otherwise
+    keys next to a $ref, such as defaults, are ignored."""
 
     validate_properties = validator_class.VALIDATORS["properties"]
 
@@ -32,53 +34,22 @@ def extend_with_default(validator_class):
         if not schema.get("ignoreDefaults"):
             for prop, subschema in properties.items():
                 # set default value
-                if "default" in subschema:
-                    # deep-copy because the default value may be mutable
-                    # and inserted multiple times
-                    value = copy.deepcopy(subschema["default"])
-                    instance.setdefault(prop, value)
+                if "default" in subschema and prop not in instance:
+                    value = subschema["default"]
+                    if isinstance(value, (dict, list)):
+                        # deep-copy because the default value is mutable
+                        # and may be inserted multiple times
+                        value = copy.deepcopy(value)
+                    instance[prop] = value
 
         for error in validate_properties(
                 validator, properties, instance, schema
             ):
             yield error
 
-    def val_ref(validator, ref, instance, schema):
-        """A special implementation of the $ref validator that takes over
-           all properties from the referring schema to the referenced one."""
-
-        def patch_resolved(resolved):
-            """Returns a copy of the given dict with all keys/values
-            from schema deep-copied over."""
-
-            patched = copy.deepcopy(resolved)
-            for key, val in schema.items():
-                if key != "$ref":
-                    patched[key] = val
-            return patched
-
-        resolve = getattr(validator.resolver, "resolve", None)
-        if resolve is None:
-            with validator.resolver.resolving(ref) as resolved:
-                resolved = patch_resolved(resolved)
-                for error in validator.descend(instance, resolved):
-                    yield error
-        else:
-            scope, resolved = validator.resolver.resolve(ref)
-            validator.resolver.push_scope(scope)
-
-            resolved = patch_resolved(resolved)
-
-            try:
-                for error in validator.descend(instance, resolved):
-                    yield error
-            finally:
-                validator.resolver.pop_scope()
-
     return validators.extend(
         validator_class, {
             "properties": val_properties,
-            "$ref": val_ref,
         }
     )
 
@@ -86,11 +57,69 @@ def extend_with_default(validator_class):
 DefaultValidatingDraft4Validator = extend_with_default(Draft4Validator)
 
 
+# validators that have already been created, by schema file
+_VALIDATORS = {}
+
+
+def resolve_refs(schema, root=None):
+    """Returns a copy of the given schema with all local $refs replaced
+    by the schemas they point to. Other keys next to a $ref are
+    copied over to the referenced schema. root is the document
+    references are looked up in and defaults to schema.
+    Recursive references are not supported."""
+
+    if root is None:
+        root = schema
+
+    if isinstance(schema, list):
+        return [resolve_refs(item, root) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+
+    ref = schema.get("$ref")
+    if not isinstance(ref, str) or not ref.startswith("#/"):
+        return {key: resolve_refs(val, root) for key, val in schema.items()}
+
+    resolved = root
+    for part in ref[2:].split("/"):
+        resolved = resolved[part]
+    resolved = resolve_refs(resolved, root)
+    for key, val in schema.items():
+        if key != "$ref":
+            resolved[key] = resolve_refs(val, root)
+    return resolved
+
+def get_validator(schema_file=SCHEMA_FILE):
+    """Returns a DefaultValidatingDraft4Validator for the schema stored
+    in the given file. The schema is loaded and its references are
+    resolved only once, later calls return the same validator."""
+
+    try:
+        return _VALIDATORS[schema_file]
+    except KeyError:
+        pass
+
+    with open(schema_file) as file:
+        schema = resolve_refs(json.load(file))
+    validator = DefaultValidatingDraft4Validator(schema)
+    _VALIDATORS[schema_file] = validator
+    return validator
+
 def validate_config(cfg, schema_file=SCHEMA_FILE):
     """Validates the given configuration, filling defaults in if required."""
 
-    schema = json.load(open(schema_file))
-    DefaultValidatingDraft4Validator(schema).validate(cfg)
+    get_validator(schema_file).validate(cfg)
+
+def copy_config(obj):
+    """Returns a copy of the given configuration data. Only dicts and
+    lists are copied, all other values are immutable and hence shared
+    with the original."""
+
+    if isinstance(obj, dict):
+        return {key: copy_config(val) for key, val in obj.items()}
+    if isinstance(obj, list):
+        return [copy_config(item) for item in obj]
+    return obj
 
 def patch_if_none(obj, key, value):
     """If obj.get(key) is None, this runs obj[key] = value."""
@@ -104,7 +133,7 @@ def parse_config(cfg):
 
     # pylint: disable=too-many-branches,too-many-locals
 
-    cfg = copy.deepcopy(cfg)
+    cfg = copy_config(cfg)
 
     # Yes, this is dirty, but the values we get from yaml can contain
     # None where we expect a dictionary to be.
@@ -112,6 +141,11 @@ def parse_config(cfg):
     patch_if_none(cfg, "temp_expression_modules", {})
     for key in cfg["temp_expression_modules"]:
         patch_if_none(cfg["temp_expression_modules"], key, {})
+    patch_if_none(cfg, "service_rate_limits", {})
+    for key in cfg["service_rate_limits"]:
+        patch_if_none(cfg["service_rate_limits"], key, {})
+    patch_if_none(cfg, "metrics", {})
+    patch_if_none(cfg, "profiler", {})
     patch_if_none(cfg, "thermostat_defaults", {})
     patch_if_none(cfg, "window_sensor_defaults", {})
     patch_if_none(cfg, "schedule_prepend", [])
@@ -153,6 +187,7 @@ def parse_config(cfg):
             for key, val in cfg["thermostat_defaults"].items():
                 therm.setdefault(key, val)
             therm["current_temp"] = None
+            therm["wanted_temp"] = None
         for sensor in room["window_sensors"].values():
             for key, val in cfg["window_sensor_defaults"].items():
                 sensor.setdefault(key, val)
@@ -160,6 +195,7 @@ def parse_config(cfg):
         room["schedule"] = parse_schedule(room["schedule"])
         room["schedule"].items.insert(0, cfg["schedule_prepend"])
         room["schedule"].items.append(cfg["schedule_append"])
+        room["schedule"].build_index()
 
     return cfg
 
@@ -172,7 +208,7 @@ def parse_schedule(rules):
         constraints = {}
         for name, value in rule.items():
             if name in RANGE_STRING_CONSTRAINTS:
-                constraints[name] = util.expand_range_string(value)
+                constraints[name] = util.parse_range_string(value)
 
         start_time = rule.get("start")
         if start_time is not None:
@@ -184,13 +220,16 @@ def parse_schedule(rules):
         end_plus_days = rule["end_plus_days"]
 
         temp_expr = rule["temp"]
+        cache_ttl = rule.get("cache_ttl")
 
         rule = schedule.Rule(temp_expr=temp_expr,
                              start_time=start_time,
                              end_time=end_time,
                              end_plus_days=end_plus_days,
-                             constraints=constraints)
+                             constraints=constraints,
+                             cache_ttl=cache_ttl)
 
         sched.items.append(rule)
 
+    sched.build_index()
     return sched
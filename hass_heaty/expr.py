@@ -3,7 +3,9 @@ Module containing functionality to evaluate temperature expressions.
 """
 
 import datetime
+import dis
 import functools
+import types
 
 
 __all__ = ["Add", "Break", "Ignore", "OFF", "Result", "Temp"]
@@ -12,16 +14,30 @@ __all__ = ["Add", "Break", "Ignore", "OFF", "Result", "Temp"]
 # special value Temp can be initialized with
 OFF = "off"
 
+# names of built-in functions that are free of side effects and can
+# safely be used in expressions whose results are cached
+PURE_BUILTINS = (
+    "abs", "all", "any", "bool", "dict", "divmod", "float", "int", "len",
+    "list", "max", "min", "range", "round", "set", "sorted", "str", "sum",
+    "tuple", "zip",
+)
+
 
 class AddibleMixin:
     """Mixin that makes a temperature expression result addible."""
-    pass
+
+    __slots__ = ()
 
 class ResultBase:
     """Holds the result of a temperature expression."""
 
+    __slots__ = ("temp",)
+
     def __init__(self, temp):
-        self.temp = Temp(temp)
+        if not isinstance(temp, Temp):
+            temp = Temp(temp)
+        # Temp objects are never modified, hence they can be shared
+        self.temp = temp
 
     def __eq__(self, other):
         return type(self) is type(other) and self.temp == other.temp
@@ -30,6 +46,8 @@ class ResultBase:
 class Result(ResultBase, AddibleMixin):
     """Final result of a temperature expression."""
 
+    __slots__ = ()
+
     def __repr__(self):
         return "{}".format(self.temp)
 
@@ -37,6 +55,8 @@ class Add(ResultBase, AddibleMixin):
     """Result of a temperature expression that is intended to be added
     to the result of a consequent expression."""
 
+    __slots__ = ()
+
     def __add__(self, other):
         if not isinstance(other, AddibleMixin):
             raise TypeError("can't add {} and {}"
@@ -49,21 +69,44 @@ class Add(ResultBase, AddibleMixin):
 
 class Break(ResultBase):
     """Result of a temperature expression that should abort scheduling and
-    leave the temperature unchanged."""
+    leave the temperature unchanged. There is only a single instance
+    of this class, which is returned by every call to Break()."""
+
+    __slots__ = ()
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            instance = super(Break, cls).__new__(cls)
+            instance.temp = None
+            cls._instance = instance
+        return cls._instance
 
     def __init__(self):
         # pylint: disable=super-init-not-called
-        self.temp = None
+        pass
 
     def __repr__(self):
         return "Break()"
 
 class Ignore(ResultBase):
-    """Result of a temperature expression which should be ignored."""
+    """Result of a temperature expression which should be ignored.
+    There is only a single instance of this class, which is returned
+    by every call to Ignore()."""
+
+    __slots__ = ()
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            instance = super(Ignore, cls).__new__(cls)
+            instance.temp = None
+            cls._instance = instance
+        return cls._instance
 
     def __init__(self):
         # pylint: disable=super-init-not-called
-        self.temp = None
+        pass
 
     def __repr__(self):
         return "Ignore()"
@@ -73,38 +116,53 @@ class Ignore(ResultBase):
 class Temp:
     """A class holding a temperature value."""
 
+    __slots__ = ("value",)
+
     def __init__(self, value):
         if isinstance(value, Temp):
             # just copy the value over
-            value = value.value
+            self.value = value.value
+            return
+        if isinstance(value, (float, int)):
+            # nothing to parse
+            self.value = float(value)
+            return
         parsed = self.parse_temp(value)
         if parsed is None:
             raise ValueError("{} is no valid temperature"
                              .format(repr(value)))
         self.value = parsed
 
+    @classmethod
+    def _make(cls, value):
+        """Creates a new Temp object with the given value, which has to
+        be a float or OFF already, without parsing it."""
+        temp = cls.__new__(cls)
+        temp.value = value
+        return temp
+
     def __add__(self, other):
-        if isinstance(other, (float, int)):
-            other = Temp(other)
-        elif not isinstance(other, Temp):
+        if isinstance(other, Temp):
+            other = other.value
+        elif isinstance(other, (float, int)):
+            other = float(other)
+        else:
             raise TypeError("can't add {} and {}"
                             .format(repr(type(self)), repr(type(other))))
 
         # OFF + something is OFF
-        if self.is_off() or other.is_off():
-            return Temp(OFF)
+        if self.value == OFF or other == OFF:
+            return OFF_TEMP
 
-        return Temp(self.value + other.value)
+        return Temp._make(self.value + other)
 
     def __neg__(self):
         # pylint: disable=invalid-unary-operand-type
         if self.is_off():
-            return Temp(self.value)
-        return Temp(-self.value)
+            return OFF_TEMP
+        return Temp._make(-self.value)
 
     def __sub__(self, other):
-        if isinstance(other, (float, int)):
-            other = Temp(other)
         return self.__add__(-other)
 
     def __eq__(self, other):
@@ -151,6 +209,11 @@ class Temp:
             return
 
 
+# shared Temp object representing OFF, which results of arithmetic
+# operations involving OFF are
+OFF_TEMP = Temp._make(OFF)  # pylint: disable=protected-access
+
+
 def build_time_expression_env():
     """This function builds and returns an environment usable as globals
     for the evaluation of a time expression. It will add all members
@@ -161,21 +224,45 @@ def build_time_expression_env():
         env[name] = globals()[name]
     return env
 
-def eval_temp_expr(temp_expr, extra_env=None):
+def get_expr_names(temp_expr):
+    """Returns a frozenset with the names of all global variables the
+    given compiled temperature expression reads, including those used
+    inside of nested lambdas and comprehensions. Attribute names are
+    not included."""
+
+    names = set()
+    for instr in dis.get_instructions(temp_expr):
+        if instr.opname in ("LOAD_GLOBAL", "LOAD_NAME"):
+            names.add(instr.argval)
+    for const in temp_expr.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(get_expr_names(const))
+    return frozenset(names)
+
+def eval_temp_expr(temp_expr, extra_env=None, env=None):
     """This method evaluates the given temperature expression.
     The evaluation result is returned. The items of the extra_env
     dict are added to the globals available during evaluation.
+    Instead of building a fresh environment with
+    build_time_expression_env(), a prepared one can be passed as env,
+    which is then used as globals directly, unless extra_env is given
+    as well. In that case, a copy of env is extended, env itself is
+    never modified.
     The result is an instance of Result."""
 
     # pylint: disable=eval-used
 
-    try:
-        return Result(temp_expr)
-    except ValueError:
-        # it's an expression, not a simple temperature value
-        pass
-
-    env = build_time_expression_env()
+    if not isinstance(temp_expr, types.CodeType):
+        try:
+            return Result(temp_expr)
+        except ValueError:
+            # it's an expression, not a simple temperature value
+            pass
+
+    if env is None:
+        env = build_time_expression_env()
+    elif extra_env:
+        env = dict(env)
     if extra_env:
         env.update(extra_env)
     result = eval(temp_expr, env)
@@ -0,0 +1,207 @@
+"""
+This module implements cheap runtime metrics, namely counters and
+latency histograms, which can be rendered in the text format of
+Prometheus.
+"""
+
+import bisect
+import functools
+import os
+import time
+
+
+__all__ = ["Metrics", "timed"]
+
+
+# upper bounds of the histograms' buckets in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1, 2.5, 5, 10)
+# all metrics as name: (type, label name, help text)
+METRICS = {
+    "heaty_callback_duration_seconds": (
+        "histogram", "callback", "Duration of callbacks invoked by AppDaemon."
+    ),
+    "heaty_api_call_duration_seconds": (
+        "histogram", "call", "Duration of calls to the AppDaemon API."
+    ),
+    "heaty_expr_eval_duration_seconds": (
+        "histogram", None, "Duration of temperature expression evaluations."
+    ),
+    "heaty_expr_errors_total": (
+        "counter", None, "Temperature expressions that raised an exception."
+    ),
+    "heaty_expr_timeouts_total": (
+        "counter", None, "Temperature expressions that timed out."
+    ),
+    "heaty_commands_sent_total": (
+        "counter", None, "Commands sent to thermostats for the first time."
+    ),
+    "heaty_command_retries_total": (
+        "counter", None, "Commands re-sent to thermostats."
+    ),
+    "heaty_commands_confirmed_total": (
+        "counter", None, "Commands thermostats reported back."
+    ),
+    "heaty_timers_started_total": (
+        "counter", "timer", "Timers started, by purpose."
+    ),
+}
+
+
+class Histogram:
+    """A latency histogram with the fixed buckets from BUCKETS."""
+
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        # the last item counts the values above the highest bound
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Adds the given value."""
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """Holds the values of all metrics listed in METRICS.
+    Values are stored by (name, label value), where the label value is
+    None for metrics without a label."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, label=None, value=1):
+        """Increments the given counter."""
+
+        key = name, label
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, label, seconds):
+        """Adds the given duration to the given histogram."""
+
+        key = name, label
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def get_summary(self):
+        """Returns a flat dict with the counters as well as the count and
+        average duration in milliseconds of the histograms, which is
+        suitable as attributes of a Home Assistant entity."""
+
+        summary = {}
+        for (name, label), value in sorted(self.counters.items(),
+                                           key=_sort_key):
+            summary[_flat_name(name, label)] = value
+        for (name, label), histogram in sorted(self.histograms.items(),
+                                               key=_sort_key):
+            flat_name = _flat_name(name[:-len("_seconds")], label)
+            summary[flat_name + "_count"] = histogram.count
+            summary[flat_name + "_avg_ms"] = round(
+                histogram.total / histogram.count * 1000, 3
+            )
+        return summary
+
+    def render_prometheus(self):
+        """Returns all metrics in the text exposition format of
+        Prometheus."""
+
+        lines = []
+        for name, (_type, label_name, help_text) in sorted(METRICS.items()):
+            if _type == "counter":
+                items = [(label, value)
+                         for (_name, label), value in self.counters.items()
+                         if _name == name]
+            else:
+                items = [(label, histogram)
+                         for (_name, label), histogram
+                         in self.histograms.items()
+                         if _name == name]
+            if not items:
+                continue
+
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, _type))
+            for label, value in sorted(items, key=lambda item: item[0] or ""):
+                labels = []
+                if label_name is not None:
+                    labels.append('{}="{}"'.format(label_name, label))
+                if _type == "counter":
+                    lines.append("{}{} {}".format(name, _labels(labels),
+                                                  value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), value.counts):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(
+                        name, _labels(labels + ['le="{}"'.format(bound)]),
+                        cumulative
+                    ))
+                lines.append("{}_sum{} {}".format(name, _labels(labels),
+                                                  value.total))
+                lines.append("{}_count{} {}".format(name, _labels(labels),
+                                                    value.count))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filename):
+        """Writes the metrics to the given file in the format of
+        Prometheus. The file is replaced atomically, so that readers
+        never see a partially written one."""
+
+        tmp_filename = "{}.tmp".format(filename)
+        with open(tmp_filename, "w") as fileobj:
+            fileobj.write(self.render_prometheus())
+        os.replace(tmp_filename, filename)
+
+
+def timed(name, label=None):
+    """Decorator for methods of objects having a metrics attribute. The
+    duration of every call is added to the given histogram. The label
+    defaults to the name of the decorated method."""
+
+    def decorator(func):
+        """The actual decorator."""
+
+        _label = label or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            """Calls func and records its duration."""
+            start = time.perf_counter()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.metrics.observe(name, _label,
+                                     time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def _flat_name(name, label):
+    """Returns the name of a metric with its label value appended."""
+
+    if name.startswith("heaty_"):
+        name = name[len("heaty_"):]
+    if label is None:
+        return name
+    return "{}_{}".format(name, label)
+
+def _labels(labels):
+    """Formats a list of label strings for Prometheus."""
+
+    if not labels:
+        return ""
+    return "{" + ",".join(labels) + "}"
+
+def _sort_key(item):
+    """Sort key for the items of Metrics.counters and .histograms."""
+    (name, label), _ = item
+    return name, label or ""
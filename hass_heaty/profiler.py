@@ -0,0 +1,90 @@
+"""
+This module implements a profiler for temperature expressions, which
+records how often and how long the expressions of every room are
+evaluated, in order to find out which ones are expensive.
+"""
+
+import collections
+
+
+__all__ = ["Profiler"]
+
+
+# columns the report can be sorted by
+SORT_KEYS = ("total", "max", "calls", "errors")
+# number of expressions statistics are kept for at most, those recorded
+# least recently are dropped first
+MAX_EXPRESSIONS = 1000
+
+
+class ExprStats:
+    """Statistics of a single temperature expression in a single room."""
+
+    __slots__ = ("calls", "total", "max", "errors")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+
+class Profiler:
+    """Holds an ExprStats object per (temp_expr_raw, room_name) for up
+    to max_expressions expressions. Expressions which are evaluated
+    only once, such as those of heaty_set_temp events, hence can't make
+    the statistics grow without bounds."""
+
+    def __init__(self, max_expressions=MAX_EXPRESSIONS):
+        self.max_expressions = max_expressions
+        self.stats = collections.OrderedDict()
+
+    def record(self, temp_expr_raw, room_name, seconds, failed=False):
+        """Records a single evaluation of the given expression in the
+        given room which took the given number of seconds. failed
+        tells whether the evaluation raised an exception."""
+
+        key = temp_expr_raw, room_name
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = ExprStats()
+            if len(self.stats) > self.max_expressions:
+                self.stats.popitem(last=False)
+        else:
+            self.stats.move_to_end(key)
+        stats.calls += 1
+        stats.total += seconds
+        if seconds > stats.max:
+            stats.max = seconds
+        if failed:
+            stats.errors += 1
+
+    def get_top(self, count, sort_key="total"):
+        """Returns a list of (temp_expr_raw, room_name, ExprStats) tuples
+        for the count expressions which are the most expensive by
+        sort_key, which has to be one of SORT_KEYS."""
+
+        items = sorted(self.stats.items(),
+                       key=lambda item: getattr(item[1], sort_key),
+                       reverse=True)
+        return [(temp_expr_raw, room_name, stats)
+                for (temp_expr_raw, room_name), stats in items[:count]]
+
+    def format_report(self, count, sort_key="total"):
+        """Returns a list of strings describing the count most expensive
+        expressions, see get_top."""
+
+        lines = []
+        for temp_expr_raw, room_name, stats in self.get_top(count, sort_key):
+            lines.append(
+                "[{}] {}: {} calls, {:.3f} ms total, {:.3f} ms avg, "
+                "{:.3f} ms max, {} errors"
+                .format(room_name, repr(temp_expr_raw), stats.calls,
+                        stats.total * 1000, stats.total / stats.calls * 1000,
+                        stats.max * 1000, stats.errors)
+            )
+        return lines
+
+    def reset(self):
+        """Removes all recorded statistics."""
+        self.stats.clear()
@@ -2,16 +2,32 @@
 This module implements the Schedule and Rule classes.
 """
 
+import bisect
+import collections
 import datetime
 
 from . import expr
 
 
+# the time every day starts with
+MIDNIGHT = datetime.time(0, 0)
+# names of all constraints a rule may have
+CONSTRAINTS = ("years", "months", "days", "weeks", "weekdays")
+# names in temperature expressions whose values depend on the exact time
+# of evaluation
+TIME_NAMES = ("now", "time", "datetime")
+# names in temperature expressions whose values don't cause side effects
+# or depend on anything but date, time and the room
+PURE_NAMES = frozenset(expr.__all__) | frozenset(expr.PURE_BUILTINS) | \
+             frozenset(TIME_NAMES) | frozenset(("date", "room_name"))
+
+
 class Rule:
     """A rule that can be added to a schedule."""
 
     def __init__(self, temp_expr, start_time=None, end_time=None,
-                 end_plus_days=0, constraints=None):
+                 end_plus_days=0, constraints=None, cache_ttl=None):
+        # pylint: disable=too-many-arguments
         if start_time is None:
             # make it midnight
             start_time = datetime.time(0, 0)
@@ -25,6 +41,17 @@ class Rule:
         if constraints is None:
             constraints = {}
         self.constraints = constraints
+        # None values are ignored, since None is not iterable
+        self._checks = tuple(
+            (constraint, allowed_values)
+            for constraint, allowed_values in sorted(constraints.items())
+            if allowed_values is not None and constraint in CONSTRAINTS
+        )
+        self._needs_isocalendar = any(
+            constraint in ("years", "weeks", "weekdays")
+            for constraint, _ in self._checks
+        )
+        self._constraints_cache = collections.OrderedDict()
 
         if isinstance(temp_expr, str):
             temp_expr = temp_expr.strip()
@@ -34,28 +61,232 @@ class Rule:
         except ValueError:
             # this is a temperature expression, precompile it
             self.temp_expr = compile(temp_expr, "temp_expr", "eval")
+            self.temp_expr_names = expr.get_expr_names(self.temp_expr)
         else:
             self.temp_expr = temp
+            self.temp_expr_names = frozenset()
+
+        # Results are cached based on what the expression reads.
+        # Expressions that may cause side effects or depend on external
+        # state (e.g. via app or modules) are only cached when a
+        # cache_ttl is given explicitly.
+        self.cache_ttl = cache_ttl
+        names = self.temp_expr_names
+        self._cacheable = names <= PURE_NAMES or cache_ttl is not None
+        self._cache_by_room = "room_name" in names
+        if any(name in names for name in TIME_NAMES):
+            self._cache_by = "now"
+        elif "date" in names:
+            self._cache_by = "date"
+        else:
+            self._cache_by = None
+        self._result_cache = {}
+        # result shared by all rooms during one evaluation cycle, used
+        # for expressions that don't depend on the room
+        self._cycle_result = None
+
+    def __repr__(self):
+        return "<Rule {}>".format(repr(self.temp_expr_raw))
+
+    def clear_cached_results(self):
+        """Drops all cached results of this rule's temperature
+        expression, e.g. because something it depends on changed."""
+
+        self._result_cache.clear()
+        self._cycle_result = None
 
     def check_constraints(self, date):
-        """Checks all constraints of this rule against the given date."""
-
-        year, week, weekday = date.isocalendar()
-        for constraint, allowed_values in self.constraints.items():
-            if allowed_values is None:
-                # ignore this one, since None is not iterable
-                continue
-            if constraint == "years" and year not in allowed_values:
-                return False
-            if constraint == "months" and date.month not in allowed_values:
-                return False
-            if constraint == "days" and date.day not in allowed_values:
-                return False
-            if constraint == "weeks" and week not in allowed_values:
-                return False
-            if constraint == "weekdays" and weekday not in allowed_values:
-                return False
-        return True
+        """Checks all constraints of this rule against the given date.
+        Results are cached for the last few dates, hence each date is
+        checked only once, no matter how often it's asked for."""
+
+        try:
+            return self._constraints_cache[date]
+        except KeyError:
+            pass
+
+        if self._needs_isocalendar:
+            year, week, weekday = date.isocalendar()
+        else:
+            year = week = weekday = None
+        values = {
+            "years": year, "months": date.month, "days": date.day,
+            "weeks": week, "weekdays": weekday,
+        }
+        result = all(values[constraint] in allowed_values
+                     for constraint, allowed_values in self._checks)
+
+        self._constraints_cache[date] = result
+        # only the dates a lookup can walk back over need to be kept,
+        # older ones are dropped as the days pass
+        while len(self._constraints_cache) > self.end_plus_days + 2:
+            self._constraints_cache.popitem(last=False)
+        return result
+
+    def _get_cache_stamp(self, now):
+        """Returns the part of now the cached result depends on."""
+
+        if self._cache_by == "now":
+            return now
+        if self._cache_by == "date":
+            return now.date()
+        return None
+
+    def get_cached_result(self, room_name, now, cycle=None):
+        """Returns the result of this rule's temperature expression that
+        was cached for the given room and datetime or None, if there is
+        no valid one. If an evaluation cycle is given and the expression
+        doesn't depend on the room, a result computed for another room
+        during the same cycle is returned as well."""
+
+        if cycle is not None and not self._cache_by_room and \
+           self._cycle_result is not None and \
+           self._cycle_result[0] == cycle:
+            return self._cycle_result[1]
+        if not self._cacheable:
+            return None
+        slot = room_name if self._cache_by_room else None
+        try:
+            stamp, expires, result = self._result_cache[slot]
+        except KeyError:
+            return None
+        if stamp != self._get_cache_stamp(now) or \
+           expires is not None and now >= expires:
+            return None
+        return result
+
+    def cache_result(self, room_name, now, result, cycle=None):
+        """Caches the result of this rule's temperature expression
+        evaluated for the given room at the given datetime, if the
+        expression allows it. See get_cached_result for cycle."""
+
+        if cycle is not None and not self._cache_by_room:
+            self._cycle_result = cycle, result
+        if not self._cacheable:
+            return
+        slot = room_name if self._cache_by_room else None
+        expires = None
+        if self.cache_ttl is not None:
+            expires = now + datetime.timedelta(seconds=self.cache_ttl)
+        self._result_cache[slot] = \
+            self._get_cache_stamp(now), expires, result
+
+    def get_day_intervals(self, date):
+        """Returns a list of (start, end) tuples of datetime.time objects
+        representing the times of the given date during which this rule
+        is valid. end is None if an interval lasts until the end of the
+        day. Empty intervals are omitted.
+        The outcome is equal to running the checks of
+        Schedule.get_matching_rules for every time of the day."""
+
+        # find out how many days back the rule's start day is
+        for first_day in range(self.end_plus_days + 1):
+            _date = date - datetime.timedelta(days=first_day)
+            if self.check_constraints(_date):
+                break
+        else:
+            # rule doesn't cover this date at all
+            return []
+
+        if self.end_plus_days == 0:
+            intervals = [(self.start_time, self.end_time)]
+        elif first_day == self.end_plus_days:
+            # rule started some days ago and ends today
+            intervals = [(MIDNIGHT, self.end_time)]
+        elif first_day == 0 and self.end_plus_days == 1:
+            # rule starts today and another one started yesterday
+            intervals = [(MIDNIGHT, self.end_time), (self.start_time, None)]
+        else:
+            # a day in the middle of the rule's period
+            intervals = [(MIDNIGHT, None)]
+
+        return [(start, end) for start, end in intervals
+                if end is None or start < end]
+
+
+class ScheduleIndex:
+    """A compiled, flattened version of a schedule which allows for fast
+    lookup of the rules matching at a given time.
+    For every date queried, the day is split into segments during which
+    the set of matching rules doesn't change. The segments of the most
+    recently used dates are cached."""
+
+    # number of dates to keep the segments of
+    CACHED_DAYS = 4
+
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        self._days = collections.OrderedDict()
+
+    def get_day(self, date):
+        """Returns a tuple (bounds, segments) for the given date.
+        bounds is a sorted list of the datetime.time objects at which
+        segments start, the first one being midnight. segments is a
+        list of the same length containing a tuple of the rules that
+        match during the respective segment, keeping the schedule's
+        order."""
+
+        try:
+            return self._days[date]
+        except KeyError:
+            pass
+
+        rules = []
+        times = {MIDNIGHT}
+        for rule in self.rules:
+            intervals = rule.get_day_intervals(date)
+            if intervals:
+                rules.append((rule, intervals))
+                for start, end in intervals:
+                    times.add(start)
+                    if end is not None:
+                        times.add(end)
+
+        bounds = []
+        segments = []
+        for _time in sorted(times):
+            segment = tuple(
+                rule for rule, intervals in rules
+                if any(start <= _time and (end is None or _time < end)
+                       for start, end in intervals)
+            )
+            # merge with the previous segment if nothing changes
+            if not segments or segment != segments[-1]:
+                bounds.append(_time)
+                segments.append(segment)
+
+        day = bounds, segments
+        self._days[date] = day
+        while len(self._days) > self.CACHED_DAYS:
+            self._days.popitem(last=False)
+        return day
+
+    def get_matching_rules(self, when):
+        """Returns a tuple of the rules that are valid at the time
+        represented by the given datetime object, keeping their order."""
+
+        bounds, segments = self.get_day(when.date())
+        return segments[bisect.bisect_right(bounds, when.time()) - 1]
+
+    def next_transition(self, after, max_days=7):
+        """Returns a datetime object representing the next point in time
+        after the given datetime at which the set of matching rules
+        changes. Only the following max_days days are searched. If no
+        change happens in that period, None is returned."""
+
+        current = self.get_matching_rules(after)
+        date = after.date()
+        bounds, segments = self.get_day(date)
+        index = bisect.bisect_right(bounds, after.time())
+        for days in range(max_days + 1):
+            if days:
+                date += datetime.timedelta(days=1)
+                bounds, segments = self.get_day(date)
+                index = 0
+            for bound, segment in zip(bounds[index:], segments[index:]):
+                if segment != current:
+                    return datetime.datetime.combine(date, bound)
+        return None
 
 
 class Schedule:
@@ -63,6 +294,7 @@ class Schedule:
 
     def __init__(self):
         self.items = []
+        self.index = None
 
     def unfold(self):
         """Returns an iterator over all rules of this schedule. Included
@@ -75,39 +307,29 @@ class Schedule:
                 for rule in item.unfold():
                     yield rule
 
+    def build_index(self):
+        """Compiles the rules of this schedule, including those of
+        sub-schedules, into a ScheduleIndex which is used for all
+        further lookups. This has to be called again after the items
+        have been modified."""
+
+        self.index = ScheduleIndex(self.unfold())
+
     def get_matching_rules(self, when):
         """Returns an iterator over all rules of the schedule that are
         valid at the time represented by the given datetime object,
         keeping the order from the items list. Rules of sub-schedules
         are included."""
 
-        _time = when.time()
-        for rule in self.unfold():
-            days_back = -1
-            found_start_day = False
-            while days_back < rule.end_plus_days:
-                days_back += 1
-                # starts with days=0 (meaning the current date)
-                _date = when.date() - datetime.timedelta(days=days_back)
-
-                found_start_day = found_start_day or \
-                                  rule.check_constraints(_date)
-                if not found_start_day:
-                    # try next day
-                    continue
-
-                # in first loop run, rule has to start today and not
-                # later than now (rule start <= when.time())
-                if days_back == 0 and rule.start_time > _time:
-                    # maybe there is a next day to try out
-                    continue
-
-                # in last loop run, rule is going to end today and that
-                # has to be later than now (rule end > when.time())
-                if days_back == rule.end_plus_days and rule.end_time <= _time:
-                    # rule finally disqualified
-                    break
-
-                # rule matches!
-                yield rule
-                break
+        if self.index is None:
+            self.build_index()
+        return iter(self.index.get_matching_rules(when))
+
+    def next_transition(self, after, max_days=7):
+        """Returns the next point in time after the given datetime at
+        which the set of matching rules changes or None, if that doesn't
+        happen within max_days days. See ScheduleIndex.next_transition."""
+
+        if self.index is None:
+            self.build_index()
+        return self.index.next_transition(after, max_days=max_days)
@@ -0,0 +1,361 @@
+"""
+This module replays schedules offline, without AppDaemon or Home
+Assistant, in order to see which temperatures a configuration would
+set over a period of time.
+
+Usage from the command line (requires PyYAML):
+
+    python3 -m hass_heaty.simulate apps.yaml heaty 2018-01-01 2019-01-01
+
+This writes the timeline of all rooms as CSV to stdout.
+"""
+
+import collections
+import csv
+import datetime
+import importlib
+import sys
+
+from . import config, expr, schedule, util
+
+
+__all__ = ["Segment", "SimulatedApp", "Simulator"]
+
+
+# default resolution of the simulation
+STEP = datetime.timedelta(minutes=1)
+# when a schedule doesn't change for this number of days, the simulation
+# jumps ahead by as many days at once
+MAX_JUMP_DAYS = 7
+
+
+# A period of time during which the temperature of a room doesn't change.
+# start is inclusive, end exclusive. temp is an expr.Temp object or None,
+# if no temperature has been set yet.
+Segment = collections.namedtuple("Segment", ("room_name", "start", "end",
+                                             "temp"))
+
+
+class SimulatedApp:
+    """A minimal stand-in for the Heaty app object that is available as
+    app inside of temperature expressions during a simulation.
+    datetime() returns the simulated time and get_state() reads from
+    the given dict mapping entity names to their complete states, as
+    returned by get_state(entity, attribute="all"). The states don't
+    change during the simulation. get_expr_state() backs the state()
+    helper of temperature expressions."""
+
+    def __init__(self, states=None):
+        self.states = states or {}
+        self.now = None
+
+    def datetime(self):
+        """Returns the simulated datetime."""
+        return self.now
+
+    def get_state(self, entity_id=None, attribute=None):
+        """Works like AppDaemon's get_state, but reads from self.states."""
+
+        if entity_id is None:
+            return self.states
+        state = self.states.get(entity_id)
+        if state is None or attribute == "all":
+            return state
+        if attribute is None:
+            return state.get("state")
+        if attribute in state:
+            return state[attribute]
+        return state.get("attributes", {}).get(attribute)
+
+    def get_expr_state(self, entity, attribute=None):
+        """Works like get_state, the states are fixed anyway."""
+        return self.get_state(entity, attribute=attribute)
+
+    def log(self, msg, level="INFO"):
+        """Discards log messages."""
+        pass
+
+
+class Simulator:
+    """Replays the schedules of a parsed configuration over a period
+    of time.
+    Instead of evaluating every minute, the simulation jumps from one
+    point in time at which the set of matching rules changes to the
+    next. Only while a rule whose expression depends on the exact time
+    (now, time or datetime) is in effect, it advances in steps of step,
+    which are aligned to midnight and default to a minute.
+    Expressions that use date are re-evaluated at midnight. The results
+    of other expressions, e.g. those reading states via app, are assumed
+    not to change at all and are computed only once per room.
+    app is made available to temperature expressions and defaults to a
+    SimulatedApp without any states. If it is a SimulatedApp, its now
+    attribute is set to the simulated time before every evaluation,
+    which makes it the clock of the simulation.
+    temp_expression_modules may be a dict of already imported modules
+    to use instead of importing those configured.
+    Like in Heaty, rules whose expressions raise an exception are
+    skipped. A (room_name, datetime, rule, exception) tuple is appended
+    to the errors list for every such evaluation.
+    evaluator may be a function taking a rule, a room name and a
+    datetime, which is used instead of eval_rule to evaluate rules.
+    It has to return the result or None, if the evaluation failed."""
+
+    def __init__(self, cfg, app=None, temp_expression_modules=None,
+                 step=STEP, evaluator=None):
+        # pylint: disable=too-many-arguments
+        self.cfg = cfg
+        self.step = step
+        if evaluator is None:
+            evaluator = self.eval_rule
+        self.evaluator = evaluator
+        if app is None:
+            app = SimulatedApp()
+        self.app = app
+        if temp_expression_modules is None:
+            temp_expression_modules = {}
+            for mod_name, mod_data in \
+                    cfg["temp_expression_modules"].items():
+                as_name = util.escape_var_name(mod_data.get("as", mod_name))
+                temp_expression_modules[as_name] = \
+                    importlib.import_module(mod_name)
+        self.temp_expression_modules = temp_expression_modules
+        self.errors = []
+        self._envs = {}
+        # rules whose expressions depend on the exact time
+        self._volatile_rules = set()
+        # rules whose expressions don't depend on date or time
+        self._constant_rules = set()
+        for room in cfg["rooms"].values():
+            for rule in room["schedule"].unfold():
+                names = rule.temp_expr_names
+                if any(name in names for name in schedule.TIME_NAMES):
+                    self._volatile_rules.add(rule)
+                elif "date" not in names:
+                    self._constant_rules.add(rule)
+        # results of constant rules by (rule, room_name), room_name is
+        # None if the expression doesn't depend on the room
+        self._results = {}
+
+    @classmethod
+    def from_raw_config(cls, raw_cfg, app=None):
+        """Parses the given configuration, as it would be found in
+        apps.yaml, and returns a Simulator for it."""
+        return cls(config.parse_config(raw_cfg), app=app)
+
+    def get_env(self, room_name):
+        """Returns the environment temperature expressions of the given
+        room are evaluated in."""
+
+        env = self._envs.get(room_name)
+        if env is None:
+            env = expr.build_time_expression_env()
+            env["app"] = self.app
+            env["state"] = getattr(self.app, "get_expr_state", None) or \
+                           self._make_state_getter()
+            env["room_name"] = room_name
+            env.update(self.temp_expression_modules)
+            self._envs[room_name] = env
+        return env
+
+    def _make_state_getter(self):
+        """Returns a state() helper for apps without get_expr_state,
+        which reads from the app's get_state."""
+
+        def get_state(entity, attribute=None):
+            return self.app.get_state(entity, attribute=attribute)
+        return get_state
+
+    def eval_rule(self, rule, room_name, now):
+        """Evaluates the expression of the given rule in the given room
+        at the given datetime and returns the result. If it raises an
+        exception, that is recorded in errors and None is returned."""
+
+        env = self.get_env(room_name)
+        for name, value in (("now", now), ("date", now.date()),
+                            ("time", now.time())):
+            if name not in self.temp_expression_modules:
+                env[name] = value
+        try:
+            return expr.eval_temp_expr(rule.temp_expr, env=env)
+        except Exception as err:  # pylint: disable=broad-except
+            self.errors.append((room_name, now, rule, err))
+            return None
+
+    def evaluate(self, room_name, now):
+        """Evaluates the schedule of the given room at the given datetime,
+        the same way Heaty does.
+        A tuple (temp, volatile) is returned. temp is the resulting
+        expr.Temp object or None, if the temperature wouldn't be changed.
+        volatile tells whether an evaluated expression depends on the
+        exact time, hence the result may change before the next
+        transition."""
+
+        room = self.cfg["rooms"][room_name]
+        if isinstance(self.app, SimulatedApp):
+            self.app.now = now
+
+        volatile = False
+        result_sum = expr.Add(0)
+        for rule in room["schedule"].get_matching_rules(now):
+            if rule in self._volatile_rules:
+                volatile = True
+            key = rule, room_name
+            if "room_name" not in rule.temp_expr_names:
+                key = rule, None
+            result = self._results.get(key)
+            if result is None:
+                result = self.evaluator(rule, room_name, now)
+                if result is None:
+                    continue
+                if rule in self._constant_rules:
+                    self._results[key] = result
+
+            if isinstance(result, expr.Break):
+                return None, volatile
+            if isinstance(result, expr.Ignore):
+                continue
+            result_sum += result
+            if isinstance(result_sum, expr.Result):
+                return result_sum.temp, volatile
+        return None, volatile
+
+    def simulate_room(self, room_name, start, end):
+        """Returns a list of Segment objects covering the given period
+        of time for the given room. Consecutive segments always have
+        different temperatures. Like in Heaty, the temperature stays
+        unchanged when the schedule yields no result (e.g. due to
+        Break())."""
+
+        room = self.cfg["rooms"][room_name]
+        sched = room["schedule"]
+        uses_date = any("date" in rule.temp_expr_names
+                        for rule in sched.unfold())
+
+        segments = []
+        seg_start = start
+        temp = None
+        when = start.replace(second=0, microsecond=0)
+        while when < end:
+            new_temp, volatile = self.evaluate(room_name, when)
+            if new_temp is not None and new_temp != temp:
+                if when > seg_start:
+                    segments.append(Segment(room_name, seg_start, when, temp))
+                    seg_start = when
+                temp = new_temp
+
+            if volatile:
+                # steps are aligned to midnight, hence only transitions
+                # during the current day can come first
+                after = sched.next_transition(when, max_days=0)
+                midnight = datetime.datetime.combine(when.date(),
+                                                     schedule.MIDNIGHT)
+                when = midnight + \
+                       ((when - midnight) // self.step + 1) * self.step
+                if after is not None:
+                    when = min(when, after)
+                continue
+            after = sched.next_transition(when, max_days=MAX_JUMP_DAYS)
+            if after is None:
+                after = datetime.datetime.combine(
+                    when.date() + datetime.timedelta(days=MAX_JUMP_DAYS),
+                    schedule.MIDNIGHT
+                )
+            if uses_date:
+                midnight = datetime.datetime.combine(
+                    when.date() + datetime.timedelta(days=1),
+                    schedule.MIDNIGHT
+                )
+                after = min(after, midnight)
+            when = after
+
+        segments.append(Segment(room_name, seg_start, end, temp))
+        return segments
+
+    def simulate(self, start, end, room_names=None):
+        """Returns a list of Segment objects covering the given period
+        of time for the given rooms (all by default), grouped by room."""
+
+        if room_names is None:
+            room_names = sorted(self.cfg["rooms"])
+        segments = []
+        for room_name in room_names:
+            segments.extend(self.simulate_room(room_name, start, end))
+        return segments
+
+
+def format_temp(temp):
+    """Returns the CSV representation of a segment's temperature."""
+
+    if temp is None:
+        return ""
+    if temp.is_off():
+        return expr.OFF
+    return repr(temp.value)
+
+def write_csv(segments, fileobj):
+    """Writes the given segments as CSV with the columns room_name,
+    start, end and temp to the given file object. temp is empty if it
+    is unknown and "off" for OFF."""
+
+    writer = csv.writer(fileobj)
+    writer.writerow(Segment._fields)
+    for seg in segments:
+        writer.writerow((seg.room_name, seg.start.isoformat(),
+                         seg.end.isoformat(), format_temp(seg.temp)))
+
+def to_arrays(segments):
+    """Converts the given segments into a dict of NumPy arrays
+    (requires NumPy):
+
+    * room_names: the names of the rooms
+    * room: index of each segment's room in room_names
+    * start, end: datetime64[m] arrays
+    * temp: float64 array, NaN if unknown or OFF
+    * off: bool array telling whether the temperature is OFF"""
+
+    import numpy  # pylint: disable=import-error
+
+    room_names = sorted(set(seg.room_name for seg in segments))
+    indices = {room_name: i for i, room_name in enumerate(room_names)}
+    temps = [
+        numpy.nan if seg.temp is None or seg.temp.is_off()
+        else seg.temp.value
+        for seg in segments
+    ]
+    return {
+        "room_names": room_names,
+        "room": numpy.array([indices[seg.room_name] for seg in segments],
+                            dtype=numpy.int32),
+        "start": numpy.array([seg.start for seg in segments],
+                             dtype="datetime64[m]"),
+        "end": numpy.array([seg.end for seg in segments],
+                           dtype="datetime64[m]"),
+        "temp": numpy.array(temps, dtype=numpy.float64),
+        "off": numpy.array([seg.temp is not None and seg.temp.is_off()
+                            for seg in segments], dtype=bool),
+    }
+
+
+def main(argv=None):
+    """Command line entry point, see the module docstring."""
+
+    import yaml  # pylint: disable=import-error
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) != 4:
+        print("Usage: python3 -m hass_heaty.simulate <apps.yaml> <app_name> "
+              "<start_date> <end_date>", file=sys.stderr)
+        return 2
+
+    with open(argv[0]) as fileobj:
+        apps = yaml.safe_load(fileobj)
+    start, end = (datetime.datetime.strptime(value, "%Y-%m-%d")
+                  for value in argv[2:4])
+    sim = Simulator.from_raw_config(apps[argv[1]])
+    write_csv(sim.simulate(start, end), sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+This module implements a per-room ring buffer recording the decisions
+made while scheduling, which can be dumped in order to find out why
+a room ended up at a particular temperature.
+"""
+
+import collections
+
+
+__all__ = ["Trace"]
+
+
+# format strings of all kinds of entries, which are formatted with the
+# arguments recorded as positional arguments
+FORMATS = {
+    "cached": "rule {0.temp_expr_raw!r}: cached result {1!r}",
+    "eval": "rule {0.temp_expr_raw!r}: evaluated to {1!r}",
+    "eval_error": "rule {0.temp_expr_raw!r}: evaluation failed",
+    "break": "rule {0.temp_expr_raw!r}: Break(), aborting scheduling",
+    "ignore": "rule {0.temp_expr_raw!r}: Ignore(), skipping rule",
+    "scheduled": "scheduled temperature is {0!r} by rule "
+                 "{1.temp_expr_raw!r}",
+    "no_result": "no temperature found in schedule",
+    "unchanged": "scheduled temperature and rule unchanged, not setting",
+    "reschedule_pending": "not scheduling due to a running re-schedule "
+                          "timer",
+    "window_open": "not setting {0!r} due to an open window",
+    "dependency": "{0}: {1} changed to {2!r}, re-scheduling",
+    "timeout": "expression {0!r} timed out, using {1!r}",
+    "manual": "manual temperature expression {0!r} evaluated to {1!r}",
+    "set_temp": "setting temperature {0!r} ({1})",
+    "redundant": "not sending {0!r} to {1} redundantly",
+    "queue": "queueing {1}/{2!r} for {0}",
+    "report": "{0} reported {1!r}",
+    "confirm": "{0} confirmed the temperature",
+    "window": "{0} is now {1!r}",
+    "schedule_timer": "schedule timer set for {0}",
+    "reschedule_timer": "re-schedule timer set for {0}",
+    "cancel_reschedule_timer": "re-schedule timer cancelled",
+}
+
+
+class Trace:
+    """Holds a ring buffer with the latest size entries for every
+    room. Entries are stored as (datetime, kind, args) tuples and only
+    formatted when they're dumped, which makes recording cheap."""
+
+    def __init__(self, size):
+        self.size = size
+        self.buffers = collections.defaultdict(
+            lambda: collections.deque(maxlen=size)
+        )
+
+    def record(self, room_name, when, kind, *args):
+        """Records an entry of the given kind (see FORMATS) for the given
+        room."""
+
+        if self.size:
+            self.buffers[room_name].append((when, kind, args))
+
+    def format_entries(self, room_name):
+        """Returns a list of strings, one for every entry recorded for the
+        given room, oldest first."""
+
+        lines = []
+        for when, kind, args in self.buffers.get(room_name, ()):
+            try:
+                text = FORMATS[kind].format(*args)
+            except (AttributeError, IndexError, KeyError):
+                text = "{} {!r}".format(kind, args)
+            lines.append("{} {}".format(when, text))
+        return lines
+
+    def clear(self, room_name=None):
+        """Removes all entries of the given room or all rooms."""
+
+        if room_name is None:
+            self.buffers.clear()
+        else:
+            self.buffers.pop(room_name, None)
@@ -2,6 +2,7 @@
 Utility functions that are used everywhere inside Heaty.
 """
 
+import bisect
 import datetime
 import re
 
@@ -12,6 +13,8 @@ RANGE_PATTERN = re.compile(r"^(\d+)\-(\d+)$")
 TIME_PATTERN = re.compile(r"^([01]\d|2[0123])[\:\.]([012345]\d)$")
 # matches any character that is not allowed in Python variable names
 INVALID_VAR_NAME_CHAR_PATTERN = re.compile(r"[^a-zA-Z_]")
+# matches any character that is not allowed in object ids of entities
+INVALID_OBJECT_ID_CHAR_PATTERN = re.compile(r"[^a-z0-9_]")
 # strftime-compatible format string for military time
 TIME_FORMAT = "%H:%M"
 
@@ -26,6 +29,12 @@ def escape_var_name(name):
         name = "_" + name
     return name
 
+def escape_object_id(name):
+    """Converts the given string to a valid object id of an entity
+       (the part after the domain). All letters are lower-cased and
+       unsupported characters are replaced by "_"."""
+    return INVALID_OBJECT_ID_CHAR_PATTERN.sub("_", name.lower())
+
 def expand_range_string(range_string):
     """Expands strings of the form '1,2-4,9,11-12 to set(1,2,3,4,9,11,12).
        Any whitespace is ignored. If a float or int is given instead of a
@@ -44,6 +53,22 @@ def expand_range_string(range_string):
             numbers.add(int(part))
     return numbers
 
+def parse_range_string(range_string):
+    """Works like expand_range_string, but returns a RangeSet instead of
+       materializing every single number of the ranges."""
+
+    if isinstance(range_string, (float, int)):
+        return RangeSet([(int(range_string), int(range_string))])
+
+    ranges = []
+    for part in "".join(range_string.split()).split(","):
+        match = RANGE_PATTERN.match(part)
+        if match is not None:
+            ranges.append((int(match.group(1)), int(match.group(2))))
+        else:
+            ranges.append((int(part), int(part)))
+    return RangeSet(ranges)
+
 def format_time(when, format_str=TIME_FORMAT):
     """Returns a string representing the given datetime.time object.
        If no strftime-compatible format is provided, the default is used."""
@@ -58,3 +83,49 @@ def parse_time_string(time_str):
     match = TIME_PATTERN.match(time_str)
     if match:
         return datetime.time(int(match.group(1)), int(match.group(2)))
+
+
+class RangeSet:
+    """An immutable set of integers which is stored as a sorted list of
+       non-overlapping ranges. Membership is tested by bisection."""
+
+    __slots__ = ("starts", "ends")
+
+    def __init__(self, ranges):
+        """ranges is an iterable of (start, end) tuples, both ends
+           included. Overlapping and adjacent ranges are merged."""
+
+        starts = []
+        ends = []
+        for start, end in sorted(ranges):
+            if end < start:
+                continue
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        self.starts = tuple(starts)
+        self.ends = tuple(ends)
+
+    def __contains__(self, value):
+        index = bisect.bisect_right(self.starts, value) - 1
+        return index >= 0 and value <= self.ends[index]
+
+    def __eq__(self, other):
+        return isinstance(other, RangeSet) and \
+               self.starts == other.starts and self.ends == other.ends
+
+    def __hash__(self):
+        return hash((self.starts, self.ends))
+
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            for value in range(start, end + 1):
+                yield value
+
+    def __repr__(self):
+        return "RangeSet({})".format(",".join(
+            str(start) if start == end else "{}-{}".format(start, end)
+            for start, end in zip(self.starts, self.ends)
+        ))
@@ -0,0 +1,23 @@
+"""
+Shared set-up of the tests, which are run with pytest from the
+repository's root directory:
+
+    python3 -m pytest tests
+
+The Heaty app is run on top of the fake AppDaemon from
+benchmarks/fake_appdaemon.py, whose virtual time lets tests advance
+through hours of timers instantly.
+"""
+
+import os
+import sys
+
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+# pylint: disable=wrong-import-position
+import fake_appdaemon
+
+fake_appdaemon.install()
@@ -0,0 +1,167 @@
+"""
+Tests for hass_heaty.app, run on top of the fake AppDaemon.
+"""
+
+import datetime
+import sys
+import time
+import types
+
+from hass_heaty.app import Heaty
+
+
+START = datetime.datetime(2018, 1, 1, 6)
+THERMOSTATS = ("climate.a", "climate.b")
+
+
+def minutes(value):
+    return datetime.timedelta(minutes=value)
+
+def make_app(cfg, now=START):
+    app = Heaty(args=cfg, states={}, now=now)
+    for therm_name in cfg["rooms"]["living"]["thermostats"]:
+        app.register_thermostat(therm_name, temperature=18,
+                                operation_mode="Heat")
+    return app
+
+def make_reconciling_app(replicate_changes):
+    cfg = {
+        "reconcile_interval": 60,
+        "master_switch": "input_boolean.heaty",
+        "rooms": {
+            "living": {
+                "replicate_changes": replicate_changes,
+                "thermostats": {therm_name: {} for therm_name in THERMOSTATS},
+                "schedule": [{"temp": 20}],
+            },
+        },
+    }
+    app = make_app(cfg)
+    app.states["input_boolean.heaty"] = {"state": "on", "attributes": {}}
+    app.initialize()
+    app.run_until(app.now + datetime.timedelta(seconds=30))
+    return app
+
+def get_thermostats(app):
+    return {
+        therm_name: (app.states[therm_name]["attributes"]["operation_mode"],
+                     app.states[therm_name]["attributes"]["temperature"])
+        for therm_name in THERMOSTATS
+    }
+
+
+def test_reconcile_keeps_manual_changes_without_replication():
+    app = make_reconciling_app(False)
+    assert get_thermostats(app) == {"climate.a": ("Heat", 20),
+                                    "climate.b": ("Heat", 20)}
+    app.change_state("climate.a", attributes={"temperature": 25})
+    app.run_until(app.now + minutes(5))
+    assert get_thermostats(app) == {"climate.a": ("Heat", 25),
+                                    "climate.b": ("Heat", 20)}
+
+def test_reconcile_replicates_manual_changes():
+    app = make_reconciling_app(True)
+    app.change_state("climate.a", attributes={"temperature": 25})
+    app.run_until(app.now + minutes(5))
+    assert get_thermostats(app) == {"climate.a": ("Heat", 25),
+                                    "climate.b": ("Heat", 25)}
+
+def test_reconcile_is_disabled_by_master_switch():
+    app = make_reconciling_app(True)
+    app.change_state("input_boolean.heaty", "off")
+    app.run_until(app.now + datetime.timedelta(seconds=30))
+    assert get_thermostats(app) == {"climate.a": ("Off", 20),
+                                    "climate.b": ("Off", 20)}
+    app.change_state("climate.b", attributes={"operation_mode": "Heat",
+                                              "temperature": 25})
+    app.run_until(app.now + minutes(5))
+    assert get_thermostats(app) == {"climate.a": ("Off", 20),
+                                    "climate.b": ("Heat", 25)}
+
+def test_reconcile_resends_lost_commands():
+    app = make_reconciling_app(False)
+    app.thermostats["climate.b"]["drop"] = lambda: True
+    app.fire_event("heaty_set_temp", room_name="living", temp=22)
+    app.run_until(app.now + minutes(10))
+    assert get_thermostats(app) == {"climate.a": ("Heat", 22),
+                                    "climate.b": ("Heat", 20)}
+    app.thermostats["climate.b"]["drop"] = lambda: False
+    app.run_until(app.now + minutes(2))
+    assert get_thermostats(app) == {"climate.a": ("Heat", 22),
+                                    "climate.b": ("Heat", 22)}
+
+def test_ack_latency_is_learned_without_retries():
+    cfg = {
+        "thermostat_defaults": {"set_temp_retries": 0},
+        "rooms": {
+            "living": {
+                "thermostats": {"climate.a": {}},
+                "schedule": [{"temp": 20, "start": "07:00", "end": "08:00"},
+                             {"temp": 16}],
+            },
+        },
+    }
+    app = Heaty(args=cfg, states={}, now=START)
+    app.register_thermostat("climate.a", delay=5, temperature=18,
+                            operation_mode="Heat")
+    app.initialize()
+    app.run_until(START + minutes(180))
+    therm = app.cfg["rooms"]["living"]["thermostats"]["climate.a"]
+    assert therm["ack_latency"] == 5
+
+def test_plan_sensor_follows_transitions():
+    cfg = {
+        "plan_sensor_prefix": "sensor.plan",
+        "rooms": {
+            "living": {
+                "thermostats": {"climate.a": {}},
+                "schedule": [{"temp": 20, "start": "06:00", "end": "22:00"},
+                             {"temp": 16}],
+            },
+        },
+    }
+    now = START.replace(hour=12)
+    app = make_app(cfg, now=now)
+    app.initialize()
+    app.run_until(now + datetime.timedelta(seconds=30))
+    state = app.states["sensor.plan_living"]
+    assert state["state"] == 20
+    assert state["attributes"]["plan"][:3] == [
+        {"start": "2018-01-01T12:00:00", "temp": 20},
+        {"start": "2018-01-01T22:00:00", "temp": 16},
+        {"start": "2018-01-02T06:00:00", "temp": 20},
+    ]
+    app.run_until(now.replace(hour=22, second=1))
+    assert app.states["sensor.plan_living"]["state"] == 16
+    app.run_until(now.replace(day=2, hour=6, second=1))
+    assert app.states["sensor.plan_living"]["state"] == 20
+
+def test_plan_evaluation_is_guarded_by_timeout(monkeypatch):
+    slow = types.ModuleType("slow")
+    def wait(value):
+        time.sleep(0.3)
+        return value
+    slow.wait = wait
+    monkeypatch.setitem(sys.modules, "slow", slow)
+    cfg = {
+        "plan_sensor_prefix": "sensor.plan",
+        "temp_expression_timeout": 0.05,
+        "temp_expression_modules": {"slow": {}},
+        "rooms": {
+            "living": {
+                "thermostats": {"climate.a": {}},
+                "schedule": [{"temp": "slow.wait(20)", "start": "06:00",
+                              "end": "22:00"},
+                             {"temp": 16}],
+            },
+        },
+    }
+    now = START.replace(hour=12)
+    app = make_app(cfg, now=now)
+    app.initialize()
+    app.run_until(now + datetime.timedelta(seconds=30))
+    # the timed out rule is ignored, like when setting temperatures
+    assert app.states["sensor.plan_living"]["attributes"]["plan"] == [
+        {"start": "2018-01-01T12:00:00", "temp": 16},
+    ]
+    assert any("timed out" in msg for _, _, msg in app.logs)
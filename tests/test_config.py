@@ -0,0 +1,67 @@
+"""
+Tests for hass_heaty.config.
+"""
+
+import copy
+
+import jsonschema
+import pytest
+
+from hass_heaty import config
+
+
+def test_resolve_refs():
+    schema = {
+        "definitions": {
+            "number": {"type": "integer"},
+            "obj": {
+                "type": "object",
+                "properties": {
+                    "x": {"$ref": "#/definitions/number", "default": 1},
+                },
+            },
+        },
+        "properties": {
+            "y": {"$ref": "#/definitions/obj"},
+            "z": {"items": [{"$ref": "#/definitions/number"}]},
+        },
+    }
+    original = copy.deepcopy(schema)
+
+    resolved = config.resolve_refs(schema)
+    assert resolved["properties"]["y"] == {
+        "type": "object",
+        "properties": {"x": {"type": "integer", "default": 1}},
+    }
+    assert resolved["properties"]["z"] == {"items": [{"type": "integer"}]}
+    # the referenced schemas are copied, not modified
+    assert schema == original
+
+def test_validator_is_cached():
+    assert config.get_validator() is config.get_validator()
+
+def test_defaults_next_to_refs():
+    cfg = {
+        "metrics": {},
+        "thermostat_defaults": {},
+        "rooms": {"living": {"thermostats": {"climate.living": {}}}},
+    }
+    config.validate_config(cfg)
+    assert cfg["master_switch"] is None
+    assert cfg["off_temp"] == "off"
+    assert cfg["metrics"]["sensor"] is None
+    assert cfg["thermostat_defaults"]["set_temp_retries"] == 4
+    # thermostats of rooms get their defaults from thermostat_defaults
+    # later, see parse_config
+    assert cfg["rooms"]["living"]["thermostats"]["climate.living"] == {}
+
+@pytest.mark.parametrize("cfg", [
+    {"trace_size": -1},
+    {"state_resync_interval": -1},
+    {"reconcile_interval": -1},
+    {"schedule_prepend": [{"temp": 20, "cache_ttl": -1}]},
+])
+def test_lower_bounds(cfg):
+    cfg["rooms"] = {}
+    with pytest.raises(jsonschema.ValidationError):
+        config.validate_config(cfg)
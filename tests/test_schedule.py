@@ -0,0 +1,210 @@
+"""
+Tests for hass_heaty.schedule.
+"""
+
+import datetime
+import random
+
+from hass_heaty import schedule, util
+
+
+def scan_matching_rules(sched, when):
+    """The linear scan Schedule.get_matching_rules used to do, which the
+    compiled index has to agree with."""
+
+    _time = when.time()
+    for rule in sched.unfold():
+        found_start_day = False
+        for days_back in range(rule.end_plus_days + 1):
+            _date = when.date() - datetime.timedelta(days=days_back)
+            found_start_day = found_start_day or \
+                              rule.check_constraints(_date)
+            if not found_start_day:
+                continue
+            if days_back == 0 and rule.start_time > _time:
+                continue
+            if days_back == rule.end_plus_days and rule.end_time <= _time:
+                break
+            yield rule
+            break
+
+def make_random_schedule(rng, rules=20):
+    """Returns a Schedule with random times, constraints and a nested
+    sub-schedule."""
+
+    def make_rule():
+        start = datetime.time(rng.randrange(24), rng.choice((0, 15, 30)))
+        end = datetime.time(rng.randrange(24), rng.choice((0, 15, 30)))
+        constraints = {}
+        if rng.random() < 0.5:
+            first = rng.randint(1, 7)
+            constraints["weekdays"] = util.RangeSet(
+                [(first, rng.randint(first, 7))]
+            )
+        if rng.random() < 0.2:
+            constraints["days"] = util.RangeSet([(rng.randint(1, 31),) * 2])
+        return schedule.Rule(rng.choice((18, 20, 22)), start_time=start,
+                             end_time=end,
+                             end_plus_days=rng.choice((0, 0, 1, 2)),
+                             constraints=constraints)
+
+    sched = schedule.Schedule()
+    sub_schedule = schedule.Schedule()
+    sub_schedule.items.extend(make_rule() for _ in range(3))
+    sched.items.extend(make_rule() for _ in range(rules))
+    sched.items.insert(rules // 2, sub_schedule)
+    return sched
+
+
+def test_index_agrees_with_linear_scan():
+    rng = random.Random(42)
+    for _ in range(10):
+        sched = make_random_schedule(rng)
+        when = datetime.datetime(2018, 1, 1)
+        while when < datetime.datetime(2018, 1, 15):
+            assert list(sched.get_matching_rules(when)) == \
+                   list(scan_matching_rules(sched, when))
+            when += datetime.timedelta(minutes=rng.choice((5, 15, 60)))
+
+def test_index_keeps_order_of_sub_schedules():
+    first = schedule.Rule(18)
+    second = schedule.Rule(19)
+    third = schedule.Rule(20)
+    sub_schedule = schedule.Schedule()
+    sub_schedule.items.append(second)
+    sched = schedule.Schedule()
+    sched.items.extend((first, sub_schedule, third))
+    when = datetime.datetime(2018, 1, 1, 12)
+    assert list(sched.get_matching_rules(when)) == [first, second, third]
+
+def test_rule_spanning_midnight():
+    rule = schedule.Rule(18, start_time=datetime.time(22, 0),
+                         end_time=datetime.time(6, 0), end_plus_days=1)
+    sched = schedule.Schedule()
+    sched.items.append(rule)
+    assert list(sched.get_matching_rules(
+        datetime.datetime(2018, 1, 1, 21, 59)
+    )) == []
+    assert list(sched.get_matching_rules(
+        datetime.datetime(2018, 1, 1, 22, 0)
+    )) == [rule]
+    assert list(sched.get_matching_rules(
+        datetime.datetime(2018, 1, 2, 5, 59)
+    )) == [rule]
+    assert list(sched.get_matching_rules(
+        datetime.datetime(2018, 1, 2, 6, 0)
+    )) == []
+
+def test_check_constraints():
+    rule = schedule.Rule(18, constraints={
+        "weekdays": util.parse_range_string("1-5"),
+        "months": util.parse_range_string("1,3"),
+        "weeks": util.parse_range_string("1-10"),
+    })
+    date = datetime.date(2018, 1, 1)
+    while date < datetime.date(2018, 12, 31):
+        _, week, weekday = date.isocalendar()
+        expected = weekday <= 5 and date.month in (1, 3) and week <= 10
+        # checked twice to hit the cache as well
+        assert rule.check_constraints(date) == expected
+        assert rule.check_constraints(date) == expected
+        date += datetime.timedelta(days=1)
+
+def test_check_constraints_cache_is_bounded():
+    rule = schedule.Rule(18, end_plus_days=2, constraints={
+        "days": util.parse_range_string("1-15"),
+    })
+    date = datetime.date(2018, 1, 1)
+    for days in range(100):
+        rule.check_constraints(date + datetime.timedelta(days=days))
+    # only the dates a lookup can walk back over are kept
+    # pylint: disable=protected-access
+    assert len(rule._constraints_cache) == rule.end_plus_days + 2
+
+def scan_next_transition(sched, after, max_days):
+    """Finds the next transition by checking every minute."""
+
+    current = list(sched.get_matching_rules(after))
+    end = datetime.datetime.combine(
+        after.date() + datetime.timedelta(days=max_days + 1),
+        schedule.MIDNIGHT
+    )
+    when = after.replace(second=0, microsecond=0)
+    while when < end:
+        when += datetime.timedelta(minutes=1)
+        if list(sched.get_matching_rules(when)) != current:
+            return when
+    return None
+
+def test_next_transition_agrees_with_scan():
+    rng = random.Random(42)
+    for _ in range(5):
+        sched = make_random_schedule(rng, rules=5)
+        after = datetime.datetime(2018, 1, 1, 0, 7)
+        for _ in range(20):
+            expected = scan_next_transition(sched, after, 1)
+            assert sched.next_transition(after, max_days=1) == expected
+            if expected is None:
+                break
+            after = expected
+
+def test_next_transition_without_changes():
+    sched = schedule.Schedule()
+    sched.items.append(schedule.Rule(18))
+    when = datetime.datetime(2018, 1, 1, 12)
+    assert sched.next_transition(when, max_days=7) is None
+
+def test_next_transition_honours_constraints():
+    sched = schedule.Schedule()
+    sched.items.append(schedule.Rule(18, constraints={
+        "days": util.parse_range_string("10"),
+    }))
+    when = datetime.datetime(2018, 1, 1, 12)
+    assert sched.next_transition(when, max_days=7) is None
+    assert sched.next_transition(when, max_days=10) == \
+           datetime.datetime(2018, 1, 10)
+
+def test_cached_results_by_date():
+    rule = schedule.Rule("20 if date.day > 3 else 18")
+    now = datetime.datetime(2018, 1, 1, 12)
+    assert rule.get_cached_result("living", now) is None
+    rule.cache_result("living", now, 18)
+    # the result doesn't depend on the room
+    assert rule.get_cached_result("kitchen", now.replace(hour=23)) == 18
+    assert rule.get_cached_result("living", now.replace(day=2)) is None
+
+def test_cached_results_by_time_and_room():
+    rule = schedule.Rule("20 if time.hour > 6 and room_name == 'a' else 18")
+    now = datetime.datetime(2018, 1, 1, 12)
+    rule.cache_result("a", now, 20)
+    assert rule.get_cached_result("a", now) == 20
+    assert rule.get_cached_result("b", now) is None
+    assert rule.get_cached_result("a", now.replace(minute=1)) is None
+
+def test_impure_results_are_only_cached_with_ttl():
+    now = datetime.datetime(2018, 1, 1, 12)
+    rule = schedule.Rule("state('sensor.temp')")
+    rule.cache_result("living", now, 20)
+    assert rule.get_cached_result("living", now) is None
+
+    rule = schedule.Rule("state('sensor.temp')", cache_ttl=60)
+    rule.cache_result("living", now, 20)
+    later = now + datetime.timedelta(seconds=59)
+    assert rule.get_cached_result("living", later) == 20
+    later = now + datetime.timedelta(seconds=60)
+    assert rule.get_cached_result("living", later) is None
+
+def test_clear_cached_results():
+    rule = schedule.Rule("Add(-1)")
+    now = datetime.datetime(2018, 1, 1, 12)
+    rule.cache_result("living", now, 20)
+    rule.clear_cached_results()
+    assert rule.get_cached_result("living", now) is None
+
+def test_cycle_results_are_shared_by_rooms():
+    rule = schedule.Rule("app.get_state('input_boolean.away')")
+    now = datetime.datetime(2018, 1, 1, 12)
+    rule.cache_result("living", now, 20, cycle=1)
+    assert rule.get_cached_result("kitchen", now, cycle=1) == 20
+    assert rule.get_cached_result("kitchen", now, cycle=2) is None
+    assert rule.get_cached_result("kitchen", now) is None
@@ -0,0 +1,133 @@
+"""
+Tests for the SendQueue and TokenBucket classes of hass_heaty.app.
+"""
+
+import datetime
+
+from hass_heaty.app import ACK_LATENCY_MAX, SendQueue, TokenBucket
+
+
+NOW = datetime.datetime(2018, 1, 1, 12)
+
+
+def seconds(value):
+    return datetime.timedelta(seconds=value)
+
+def make_cmd(temp, priority=1, due=NOW, left_retries=0):
+    return {
+        "calls": [("climate/set_operation_mode", "operation_mode", "Heat"),
+                  ("climate/set_temperature", "temperature", temp)],
+        "priority": priority,
+        "due": due,
+        "left_retries": left_retries,
+        "retry_interval": 10,
+    }
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=0.5, burst=2)
+    assert bucket.get_wait_time(NOW, 2) == 0
+    bucket.take(NOW, 2)
+    assert bucket.get_wait_time(NOW) == 2
+    assert bucket.get_wait_time(NOW + seconds(1)) == 1
+    # never more than burst tokens
+    assert bucket.get_wait_time(NOW + seconds(100), 2) == 0
+    assert bucket.tokens == 2
+
+def test_token_bucket_count_above_burst():
+    bucket = TokenBucket(rate=1, burst=2)
+    # waits for a full bucket only
+    assert bucket.get_wait_time(NOW, 5) == 0
+    bucket.take(NOW, 5)
+    # the debt delays the following actions
+    assert bucket.get_wait_time(NOW) == 4
+
+def test_newer_command_replaces_pending_one():
+    queue = SendQueue()
+    queue.put("climate.a", make_cmd(20))
+    queue.put("climate.a", make_cmd(21))
+    calls, sent = queue.pop_due(NOW)
+    assert [therm_name for therm_name, _ in sent] == ["climate.a"]
+    assert calls[1] == ("climate/set_temperature", "temperature", 21,
+                        ["climate.a"])
+    assert "climate.a" not in queue
+
+def test_equal_calls_are_merged():
+    queue = SendQueue()
+    queue.put("climate.a", make_cmd(20))
+    queue.put("climate.b", make_cmd(20))
+    queue.put("climate.c", make_cmd(22))
+    calls, _ = queue.pop_due(NOW)
+    assert calls == [
+        ("climate/set_operation_mode", "operation_mode", "Heat",
+         ["climate.a", "climate.b", "climate.c"]),
+        ("climate/set_temperature", "temperature", 20,
+         ["climate.a", "climate.b"]),
+        ("climate/set_temperature", "temperature", 22, ["climate.c"]),
+    ]
+
+def test_commands_that_are_not_due_stay_queued():
+    queue = SendQueue()
+    queue.put("climate.a", make_cmd(20, due=NOW + seconds(30)))
+    assert queue.pop_due(NOW) == ([], [])
+    assert queue.next_due() == NOW + seconds(30)
+
+def test_rate_limit_prefers_higher_priorities():
+    queue = SendQueue({"climate/set_temperature": {"rate": 0.1, "burst": 1}})
+    queue.put("climate.a", make_cmd(20, priority=1))
+    queue.put("climate.b", make_cmd(21, priority=0))
+    calls, sent = queue.pop_due(NOW)
+    assert [therm_name for therm_name, _ in sent] == ["climate.b"]
+    assert calls[-1][-1] == ["climate.b"]
+    # postponed until the bucket has a token again
+    assert queue.next_due() == NOW + seconds(10)
+    _, sent = queue.pop_due(NOW + seconds(10))
+    assert [therm_name for therm_name, _ in sent] == ["climate.a"]
+
+def test_commands_needing_more_tokens_than_burst_are_sent():
+    queue = SendQueue({"climate/set_temperature": {"rate": 1, "burst": 1}})
+    cmd = make_cmd(20)
+    cmd["calls"].append(("climate/set_temperature", "target_temp_low", 18))
+    queue.put("climate.a", cmd)
+    _, sent = queue.pop_due(NOW)
+    assert [therm_name for therm_name, _ in sent] == ["climate.a"]
+
+def test_retries():
+    queue = SendQueue()
+    queue.put("climate.a", make_cmd(20, left_retries=1))
+    _, sent = queue.pop_due(NOW)
+    assert sent[0][1]["retry_in"] is not None
+    assert "climate.a" in queue
+    due = queue.next_due()
+    # the retry interval is varied by up to RETRY_JITTER
+    assert NOW + seconds(7) <= due <= NOW + seconds(13)
+    _, sent = queue.pop_due(due)
+    assert sent[0][1]["retry_in"] is None
+    assert "climate.a" not in queue
+
+def test_sent_at_is_recorded_for_first_sending():
+    queue = SendQueue()
+    queue.put("climate.a", make_cmd(20))
+    queue.pop_due(NOW)
+    assert queue.pop_sent_at("climate.a", NOW + seconds(5)) == NOW
+    # it is forgotten once popped
+    assert queue.pop_sent_at("climate.a", NOW + seconds(5)) is None
+
+def test_sent_at_is_dropped_by_resending_or_replacing():
+    queue = SendQueue()
+    queue.put("climate.a", make_cmd(20, left_retries=1))
+    queue.pop_due(NOW)
+    queue.pop_due(queue.next_due())
+    assert queue.pop_sent_at("climate.a", NOW + seconds(20)) is None
+
+    queue.put("climate.a", make_cmd(20))
+    queue.pop_due(NOW)
+    queue.put("climate.a", make_cmd(21))
+    assert queue.pop_sent_at("climate.a", NOW + seconds(5)) is None
+
+def test_sent_at_expires():
+    queue = SendQueue()
+    queue.put("climate.a", make_cmd(20))
+    queue.pop_due(NOW)
+    later = NOW + seconds(ACK_LATENCY_MAX + 1)
+    assert queue.pop_sent_at("climate.a", later) is None
@@ -0,0 +1,126 @@
+"""
+Tests for hass_heaty.simulate.
+"""
+
+import datetime
+import io
+
+from hass_heaty import config, expr, simulate
+
+
+START = datetime.datetime(2018, 1, 1)
+
+
+def make_simulator(schedule, app=None, **kwargs):
+    cfg = {"rooms": {"living": {"thermostats": {"climate.living": {}},
+                                "schedule": schedule}}}
+    return simulate.Simulator(config.parse_config(cfg), app=app, **kwargs)
+
+def brute_force(sim, room_name, start, end):
+    """Evaluates the schedule every minute and returns the
+    (datetime, temp) pairs of the resulting timeline."""
+
+    timeline = []
+    temp = None
+    when = start
+    while when < end:
+        new_temp, _ = sim.evaluate(room_name, when)
+        if new_temp is not None:
+            temp = new_temp
+        timeline.append((when, temp))
+        when += datetime.timedelta(minutes=1)
+    return timeline
+
+def assert_segments_agree(segments, timeline):
+    index = 0
+    for when, temp in timeline:
+        while not segments[index].start <= when < segments[index].end:
+            index += 1
+        assert segments[index].temp == temp, (when, segments[index], temp)
+
+
+def test_simple_schedule():
+    sim = make_simulator([{"temp": 20, "start": "06:00", "end": "22:00"},
+                          {"temp": 16}])
+    end = START + datetime.timedelta(days=2)
+    segments = sim.simulate(START, end)
+    assert [(seg.start.isoformat(), seg.temp.value) for seg in segments] == [
+        ("2018-01-01T00:00:00", 16),
+        ("2018-01-01T06:00:00", 20),
+        ("2018-01-01T22:00:00", 16),
+        ("2018-01-02T06:00:00", 20),
+        ("2018-01-02T22:00:00", 16),
+    ]
+    assert segments[-1].end == end
+    assert not sim.errors
+
+def test_agrees_with_brute_force():
+    schedule = [
+        {"temp": "18 + (time.minute // 20)", "start": "06:00",
+         "end": "07:00"},
+        {"temp": "date.day % 5 + 15", "weekdays": "6"},
+        {"temp": "Break()", "start": "12:00", "end": "13:00",
+         "months": "2"},
+        {"temp": "Add(-1) if app.get_state('input_boolean.absent') == 'on' "
+                 "else Ignore()"},
+        {"temp": 20, "start": "08:00", "end": "23:00", "weekdays": "1-5"},
+        {"temp": 17},
+    ]
+    app = simulate.SimulatedApp({"input_boolean.absent": {"state": "on"}})
+    start = datetime.datetime(2018, 1, 25)
+    end = datetime.datetime(2018, 2, 10)
+    segments = make_simulator(schedule, app=app).simulate_room(
+        "living", start, end
+    )
+    timeline = brute_force(make_simulator(schedule, app=app), "living",
+                           start, end)
+    assert_segments_agree(segments, timeline)
+    # consecutive segments have different temperatures
+    for seg, next_seg in zip(segments, segments[1:]):
+        assert seg.end == next_seg.start
+        assert seg.temp != next_seg.temp
+
+def test_errors_are_recorded():
+    sim = make_simulator([{"temp": "1/0", "start": "12:00", "end": "13:00"},
+                          {"temp": 18}])
+    segments = sim.simulate(START, START + datetime.timedelta(days=1))
+    assert [seg.temp.value for seg in segments] == [18]
+    assert sim.errors
+    room_name, when, _, err = sim.errors[0]
+    assert room_name == "living"
+    assert when == START.replace(hour=12)
+    assert isinstance(err, ZeroDivisionError)
+
+def test_custom_evaluator():
+    calls = []
+    def evaluator(rule, room_name, now):
+        calls.append(now)
+        return expr.Result(21)
+
+    sim = make_simulator([{"temp": 18}], evaluator=evaluator)
+    segments = sim.simulate(START, START + datetime.timedelta(days=2))
+    assert [seg.temp.value for seg in segments] == [21]
+    # the result of a constant expression is computed only once
+    assert calls == [START]
+
+def test_app_without_get_expr_state():
+    class App:
+        @staticmethod
+        def get_state(entity_id=None, attribute=None):
+            return {"sensor.temp": "19"}.get(entity_id)
+
+    sim = make_simulator([{"temp": "float(state('sensor.temp'))"}],
+                         app=App())
+    segments = sim.simulate(START, START + datetime.timedelta(days=1))
+    assert [seg.temp.value for seg in segments] == [19]
+
+def test_write_csv():
+    sim = make_simulator([{"temp": "OFF", "start": "06:00", "end": "22:00"},
+                          {"temp": 16}])
+    fileobj = io.StringIO()
+    simulate.write_csv(sim.simulate(START, START.replace(hour=12)), fileobj)
+    assert fileobj.getvalue().splitlines() == [
+        "room_name,start,end,temp",
+        "living,2018-01-01T00:00:00,2018-01-01T06:00:00,16.0",
+        "living,2018-01-01T06:00:00,2018-01-01T12:00:00,off",
+    ]
@@ -0,0 +1,38 @@
+"""
+Tests for hass_heaty.util.
+"""
+
+import random
+
+from hass_heaty import util
+
+
+def test_range_set_merges_ranges():
+    ranges = util.RangeSet([(5, 7), (1, 2), (3, 3), (6, 9), (12, 11)])
+    assert ranges.starts == (1, 5)
+    assert ranges.ends == (3, 9)
+    assert list(ranges) == [1, 2, 3, 5, 6, 7, 8, 9]
+    assert repr(ranges) == "RangeSet(1-3,5-9)"
+
+def test_range_set_membership():
+    rng = random.Random(42)
+    for _ in range(100):
+        ranges = [(start, start + rng.randrange(5))
+                  for start in rng.sample(range(60), 8)]
+        expected = set()
+        for start, end in ranges:
+            expected.update(range(start, end + 1))
+        range_set = util.RangeSet(ranges)
+        for value in range(-1, 70):
+            assert (value in range_set) == (value in expected)
+
+def test_range_set_equality():
+    assert util.RangeSet([(1, 3)]) == util.RangeSet([(1, 2), (3, 3)])
+    assert hash(util.RangeSet([(1, 3)])) == \
+           hash(util.RangeSet([(1, 2), (3, 3)]))
+    assert util.RangeSet([(1, 3)]) != util.RangeSet([(1, 4)])
+
+def test_parse_range_string_agrees_with_expand_range_string():
+    for range_string in ("1", "1,3", "1-3, 5,7-9", " 2 - 4 ,4-6", 7, 7.0):
+        assert set(util.parse_range_string(range_string)) == \
+               util.expand_range_string(range_string)